@@ -21,10 +21,24 @@ Controls
 * Space bar to shoot
 * f key to toggle between fullscreen.
 
+Stress mode
+-----------
+
+``python aliens.py --stress [frames]`` sends waves of hundreds of aliens that all
+drop bombs, as a scaling benchmark. The fleet and its bombs are not sprites but
+Swarms (lists of Rects advanced in one batched step). The frame rate is not
+capped, the player cannot die, and a timing report is printed at exit.
+
 """
 
 import os
 import random
+import sys
+import time
+from array import array
+from collections import deque
+from itertools import compress, repeat
+from operator import attrgetter, ge, not_
 from typing import List
 
 # import basic pygame modules
@@ -42,6 +56,12 @@ BOMB_ODDS = 60  # chances a new bomb will drop
 ALIEN_RELOAD = 12  # frames between new aliens
 SCREENRECT = pg.Rect(0, 0, 640, 480)
 SCORE = 0
+STRESS_WAVE_ROWS = 6  # a stress mode wave is STRESS_WAVE_ROWS x STRESS_WAVE_COLUMNS aliens
+STRESS_WAVE_COLUMNS = 50
+STRESS_WAVE_RELOAD = 80  # frames between waves
+STRESS_MAX_ALIENS = 3000  # no new wave while the fleet is this big
+STRESS_BOMB_ODDS = 200  # each alien drops a bomb once every this many frames on average
+STRESS_MAX_SHOTS = 20
 
 main_dir = os.path.split(os.path.abspath(__file__))[0]
 
@@ -144,9 +164,10 @@ class Explosion(pg.sprite.Sprite):
     images: List[pg.Surface] = []
 
     def __init__(self, actor, *groups):
+        """actor is a sprite, or just a Rect (a ship or bomb of a Swarm)."""
         pg.sprite.Sprite.__init__(self, *groups)
         self.image = self.images[0]
-        self.rect = self.image.get_rect(center=actor.rect.center)
+        self.rect = self.image.get_rect(center=getattr(actor, "rect", actor).center)
         self.life = self.defaultlife
 
     def update(self):
@@ -211,6 +232,138 @@ class Bomb(pg.sprite.Sprite):
             self.kill()
 
 
+class Swarm:
+    """Many identical objects kept as a list of Rects instead of one Sprite each.
+
+    Subclasses keep any other per-object state in arrays parallel to rects (see
+    columns()) and advance everything with map() over the C level Rect methods,
+    so a step costs no Python bytecode per object. Removal swaps the last object
+    into the hole, and collisions use Rect.collidelistall on the whole list.
+    By default every object is drawn with the same image; subclasses that animate
+    override images().
+    """
+
+    def __init__(self, image=None):
+        self.image = image
+        self.rects: List[pg.Rect] = []
+        self.last_rects: List[pg.Rect] = []
+
+    def __len__(self):
+        return len(self.rects)
+
+    def columns(self):
+        """All the parallel per-object lists/arrays, rects first."""
+        return [self.rects]
+
+    def images(self):
+        """An iterable with the image of every object, in rects order."""
+        return repeat(self.image, len(self.rects))
+
+    def remove(self, indices):
+        columns = self.columns()
+        for i in sorted(set(indices), reverse=True):
+            for values in columns:
+                values[i] = values[-1]
+                values.pop()
+
+    def collide(self, rect):
+        """Indices of the objects whose rect overlaps rect."""
+        return rect.collidelistall(self.rects)
+
+    def collide_group(self, group):
+        """Like groupcollide(swarm, group, 1, 1).
+
+        Both the hit objects and the sprites that hit them are removed.
+        Returns the rects of the removed objects (for explosions).
+        """
+        rects = self.rects
+        hit = set()
+        for sprite in group.sprites():
+            indices = sprite.rect.collidelistall(rects)
+            if indices:
+                hit.update(indices)
+                sprite.kill()
+        wrecks = [rects[i] for i in hit]
+        self.remove(hit)
+        return wrecks
+
+    def clear(self, screen, background):
+        screen.blits(zip(repeat(background), self.last_rects, self.last_rects), doreturn=False)
+
+    def draw(self, screen):
+        """Blit every object once and return the dirty rects, like RenderUpdates.draw."""
+        rects = screen.blits(zip(self.images(), self.rects))
+        dirty = self.last_rects + rects
+        self.last_rects = rects
+        return dirty
+
+
+class Fleet(Swarm):
+    """The aliens of the stress mode.
+
+    Does what Alien.update does for every ship at once: move by facing, bounce
+    down a row and turn around at the screen edges, and cycle the animation.
+    Only the ships that left the screen this frame run Python code. Animation
+    frames are not stored per ship; a ship only remembers its phase in the
+    animation loop, and images() looks the frame up in a per-tick table.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.facing = array("i")
+        self.phase = array("B")
+        self.frame = 0
+
+    def columns(self):
+        return [self.rects, self.facing, self.phase]
+
+    def spawn_wave(self, rows=STRESS_WAVE_ROWS, columns=STRESS_WAVE_COLUMNS):
+        """Add a formation at the top of the screen, each row heading the other way."""
+        width, height = Alien.images[0].get_size()
+        pitch = (SCREENRECT.width - width) / max(1, columns - 1)
+        loop = Alien.animcycle * len(Alien.images)
+        for row in range(rows):
+            facing = Alien.speed if row % 2 else -Alien.speed
+            for column in range(columns):
+                self.rects.append(pg.Rect(round(column * pitch), row * (height + 1), width, height))
+                self.facing.append(facing)
+                self.phase.append((self.frame + column) % loop)
+
+    def update(self):
+        rects, facing = self.rects, self.facing
+        count = len(rects)
+        self.frame += 1
+        deque(map(pg.Rect.move_ip, rects, facing, repeat(0, count)), 0)
+        for i in compress(range(count), map(not_, map(SCREENRECT.contains, rects))):
+            rect = rects[i]
+            facing[i] = -facing[i]
+            rect.top = rect.bottom + 1
+            rect.clamp_ip(SCREENRECT)
+
+    def images(self):
+        cycle, images = Alien.animcycle, Alien.images
+        loop = cycle * len(images)
+        table = [images[(self.frame - phase) % loop // cycle] for phase in range(loop)]
+        return map(table.__getitem__, self.phase)
+
+
+class Salvo(Swarm):
+    """The bombs of the stress mode. They all fall at Bomb.speed."""
+
+    def drop(self, alien_rect):
+        self.rects.append(self.image.get_rect(midbottom=alien_rect.move(0, 5).midbottom))
+
+    def update(self):
+        """Move every bomb down; return the rects of those that hit the ground."""
+        rects = self.rects
+        count = len(rects)
+        deque(map(pg.Rect.move_ip, rects, repeat(0, count), repeat(Bomb.speed, count)), 0)
+        landed = list(compress(range(count), map(ge, map(attrgetter("bottom"), rects), repeat(470))))
+        wrecks = [rects[i] for i in landed]
+        self.remove(landed)
+        return wrecks
+
+
 class Score(pg.sprite.Sprite):
     """to keep track of the score."""
 
@@ -231,7 +384,8 @@ class Score(pg.sprite.Sprite):
             self.image = self.font.render(msg, 0, self.color)
 
 
-def main(winstyle=0):
+def main(winstyle=0, stress=False, frames=0):
+    """Run the game. stress turns on the stress mode; frames > 0 stops after that many frames."""
     # Initialize pygame
     if pg.get_sdl_version()[0] == 2:
         pg.mixer.pre_init(44100, 32, 2, 1024)
@@ -284,27 +438,36 @@ def main(winstyle=0):
     bombs = pg.sprite.Group()
     all = pg.sprite.RenderUpdates()
     lastalien = pg.sprite.GroupSingle()
+    fleet = Fleet()  # only used in stress mode
+    salvo = Salvo(Bomb.images[0])
+    swarms = (fleet, salvo)
 
     # Create Some Starting Values
     alienreload = ALIEN_RELOAD
+    max_shots = STRESS_MAX_SHOTS if stress else MAX_SHOTS
     clock = pg.time.Clock()
+    stats = {"frames": 0, "aliens": 0, "bombs": 0, "step": 0.0, "collide": 0.0, "draw": 0.0}
+    started = time.perf_counter()
 
     # initialize our starting sprites
     global SCORE
     player = Player(all)
-    Alien(
-        aliens, all, lastalien
-    )  # note, this 'lives' because it goes into a sprite group
+    if stress:
+        fleet.spawn_wave()
+    else:
+        Alien(
+            aliens, all, lastalien
+        )  # note, this 'lives' because it goes into a sprite group
     if pg.font:
         all.add(Score(all))
 
     # Run our main loop whilst the player is alive.
-    while player.alive():
+    while player.alive() and not (frames and stats["frames"] >= frames):
         # get input
         for event in pg.event.get():
-            if event.type == pg.QUIT:
-                return
-            if event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE:
+            if event.type == pg.QUIT or (event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE):
+                if stress:
+                    stress_report(stats, started)
                 return
             if event.type == pg.KEYDOWN:
                 if event.key == pg.K_f:
@@ -329,20 +492,65 @@ def main(winstyle=0):
 
         # clear/erase the last drawn sprites
         all.clear(screen, background)
+        for swarm in swarms:
+            swarm.clear(screen, background)
 
         # update all the sprites
+        step_start = time.perf_counter()
         all.update()
 
         # handle player input
         direction = keystate[pg.K_RIGHT] - keystate[pg.K_LEFT]
         player.move(direction)
         firing = keystate[pg.K_SPACE]
-        if not player.reloading and firing and len(shots) < MAX_SHOTS:
+        if (stress or not player.reloading) and firing and len(shots) < max_shots:
             Shot(player.gunpos(), shots, all)
             if pg.mixer and shoot_sound is not None:
                 shoot_sound.play()
         player.reloading = firing
 
+        if stress:
+            # Move the whole fleet and its bombs, send a new wave now and then
+            fleet.update()
+            for rect in salvo.update():
+                Explosion(rect, all)
+            if alienreload:
+                alienreload = alienreload - 1
+            elif len(fleet) < STRESS_MAX_ALIENS:
+                fleet.spawn_wave()
+                alienreload = STRESS_WAVE_RELOAD
+            if fleet:
+                # about one bomb per alien every STRESS_BOMB_ODDS frames
+                drops = int(len(fleet) / STRESS_BOMB_ODDS + random.random())
+                for i in random.sample(range(len(fleet)), min(drops, len(fleet))):
+                    salvo.drop(fleet.rects[i])
+            stats["step"] += time.perf_counter() - step_start
+
+            # Collisions; aliens fly past the player and bombs only explode,
+            # so the fleet keeps growing and the benchmark keeps going
+            collide_start = time.perf_counter()
+            for rect in fleet.collide_group(shots):
+                Explosion(rect, all)
+                SCORE = SCORE + 1
+            bombed = salvo.collide(player.rect)
+            if bombed:
+                Explosion(player, all)
+                salvo.remove(bombed)
+            stats["collide"] += time.perf_counter() - collide_start
+
+            draw_start = time.perf_counter()
+            all.draw(screen)
+            fleet.draw(screen)
+            salvo.draw(screen)
+            # thousands of dirty rects would cover most of the screen anyway
+            pg.display.flip()
+            stats["draw"] += time.perf_counter() - draw_start
+            stats["frames"] += 1
+            stats["aliens"] = max(stats["aliens"], len(fleet))
+            stats["bombs"] = max(stats["bombs"], len(salvo))
+            clock.tick()  # not capped: the frame rate is the result
+            continue
+
         # Create new alien
         if alienreload:
             alienreload = alienreload - 1
@@ -384,13 +592,33 @@ def main(winstyle=0):
 
         # cap the framerate at 40fps. Also called 40HZ or 40 times per second.
         clock.tick(40)
+        stats["frames"] += 1
 
+    if stress:
+        stress_report(stats, started)
+        return
     if pg.mixer:
         pg.mixer.music.fadeout(1000)
     pg.time.wait(1000)
 
 
+def stress_report(stats, started):
+    """Print how the stress mode went."""
+    frames = max(1, stats["frames"])
+    elapsed = time.perf_counter() - started
+    print(
+        f"stress: {stats['frames']} frames, {stats['frames'] / elapsed:.1f} fps, "
+        f"up to {stats['aliens']} aliens and {stats['bombs']} bombs; per frame "
+        f"step {stats['step'] / frames * 1000:.2f} ms, collide {stats['collide'] / frames * 1000:.2f} ms, "
+        f"draw {stats['draw'] / frames * 1000:.2f} ms"
+    )
+
+
 # call the "main" function if running this script
 if __name__ == "__main__":
-    main()
+    if "--stress" in sys.argv:
+        args = sys.argv[sys.argv.index("--stress") + 1:]
+        main(stress=True, frames=int(args[0]) if args and args[0].isdigit() else 0)
+    else:
+        main()
     pg.quit()
@@ -0,0 +1,541 @@
+#!/usr/bin/env python
+"""
+ゲームの性能を測るベンチマーク
+
+使い方:
+    python bench.py atlas    個別ファイルとアトラスで、起動時の画像読み込み時間と描画(blit)速度を比べる
+    python bench.py bundle   個別ファイルとassets.bundleで、起動時の素材読み込み(Assets)の時間を比べる
+    python bench.py background   以前の毎フレーム全画面2回のblitと、Starfieldの1フレームあたりの背景処理時間を比べる
+    python bench.py pause    対戦中と一時停止中のCPU使用率を比べる
+    python bench.py arena    対戦の場の広さとスプライトの数を変えて、全部描く場合とカメラで間引く場合の描画時間を比べる
+    python bench.py fleet    aliens.pyのエイリアンを、1体ずつのスプライトとFleetの一括更新で動かして当たり判定する時間を比べる
+    python bench.py entities 弾・爆弾・アイテム・爆発を10000個ずつ作り、以前のスプライトとEntityで1個あたりのメモリ使用量を比べる
+    python bench.py patterns 曲がりながら加速する全周弾を、毎フレーム三角関数で動かす場合と軌道表で動かす場合の更新時間を比べる
+    python bench.py present  ウィンドウの大きさ(1倍・2倍・3倍・4倍)ごとに、対戦中の1フレームと画面全体をウィンドウに出す時間を測る
+    python bench.py startup  ゲームを--startupで何度も起動し直して、最初の画面が出るまでと操作できるようになるまでの時間を測る
+    python bench.py history  30万件の対戦の記録を入れたデータベースで、ランキングなどの問い合わせと書き込みの時間を測る
+
+画面の無い環境でも動くよう、SDL_VIDEODRIVERが未設定ならdummyドライバを使う。
+"""
+
+import contextlib
+import importlib.util
+import io
+import math
+import os
+import random
+import re
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pygame as pg
+
+main_dir = os.path.split(os.path.abspath(__file__))[0]
+
+
+def load_game():
+    """
+    ファイル名に'-'を含むため、importlibでゲーム本体を読み込む
+    """
+    spec = importlib.util.spec_from_file_location("koukaton", os.path.join(main_dir, "suta-_koukaton.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def setup_display(size=(640, 480)):
+    pg.init()
+    return pg.display.set_mode(size)
+
+
+def measure(func, repeat):
+    """
+    funcをrepeat回実行し、1回あたりの時間(ms)の中央値を返す
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def bench_atlas(repeat=50, blits=5000):
+    game = load_game()
+    screen = setup_display(game.SCREENRECT.size)
+    game.BUNDLE = game.Bundle("")  # アトラスだけの効果を測るため個別ファイルから読む
+    atlas = game.ATLAS
+    atlas.load()
+    if not atlas.index:
+        raise SystemExit("data/atlas.json not found, run 'python pack_assets.py atlas' first")
+    names = list(atlas.index)
+
+    def load_loose():
+        images = []
+        for name in names:
+            image = pg.image.load(os.path.join(main_dir, name)).convert()
+            images.append(image)
+        return images
+
+    def load_atlas():
+        fresh = game.Atlas(atlas.image_file, atlas.index_file)
+        return [fresh.get(name) for name in names]
+
+    loose_ms = measure(load_loose, repeat)
+    atlas_ms = measure(load_atlas, repeat)
+    print(f"startup: {len(names)} images")
+    print(f"  loose files : {loose_ms:8.2f} ms  ({len(names)} file opens)")
+    print(f"  atlas       : {atlas_ms:8.2f} ms  (1 file open)")
+
+    rng = random.Random(0)
+    positions = [(rng.randrange(0, 560), rng.randrange(0, 400)) for _ in range(blits)]
+    sequences = {}
+    for label, images in (("loose files", load_loose()), ("atlas", load_atlas())):
+        # ゲーム中と同じように、画像を順に入れ替えながら描画する
+        sequences[label] = [(images[i % len(images)], pos) for i, pos in enumerate(positions)]
+    # 計測のぶれが片方に偏らないよう、交互に描画して測る
+    times = {label: [] for label in sequences}
+    for _ in range(repeat):
+        for label, sequence in sequences.items():
+            times[label].append(measure(lambda: screen.blits(sequence, doreturn=False), 1))
+    for label, values in times.items():
+        ms = statistics.median(values)
+        print(f"blit {label:11s} : {ms:8.2f} ms / {blits} blits  ({blits / ms * 1000:10.0f} blits/s)")
+
+
+def bench_bundle(repeat=10):
+    game = load_game()
+    setup_display(game.SCREENRECT.size)
+    if not os.path.exists(game.BUNDLE_FILE):
+        raise SystemExit("assets.bundle not found, run 'python pack_assets.py bundle' first")
+
+    def startup(bundle_file):
+        def run():
+            # 毎回まっさらな状態から読み込む
+            game.BUNDLE = game.Bundle(bundle_file)
+            game.ATLAS = game.Atlas(game.ATLAS.image_file, game.ATLAS.index_file)
+            game.Win.surfaces.clear()
+            game.Assets()
+        return run
+
+    def read_all(bundle_file):
+        def run():
+            # デコードを除いた、ファイルを開いて中身を読むだけの時間
+            bundle = game.Bundle(bundle_file)
+            for name in names:
+                asset = bundle.open(name) or open(os.path.join(main_dir, *name.split("/")), "rb")
+                with asset:
+                    asset.read()
+        return run
+
+    names = list(game.Bundle(game.BUNDLE_FILE).names("data")) + game.Bundle(game.BUNDLE_FILE).names("characters")
+    # 交互に測って、測っている間の負荷の変化がどちらかに偏らないようにする
+    loose_ms, bundle_ms, loose_read_ms, bundle_read_ms = [], [], [], []
+    for _ in range(repeat):
+        loose_ms.append(measure(startup(""), 1))
+        bundle_ms.append(measure(startup(game.BUNDLE_FILE), 1))
+        loose_read_ms.append(measure(read_all(""), 1))
+        bundle_read_ms.append(measure(read_all(game.BUNDLE_FILE), 1))
+    rows = (
+        ("startup (Assets)", loose_ms, bundle_ms),
+        (f"open and read {len(names)} files", loose_read_ms, bundle_read_ms),
+    )
+    for title, loose, bundle in rows:
+        loose, bundle = statistics.median(loose), statistics.median(bundle)
+        print(f"{title}:")
+        print(f"  loose files : {loose:8.2f} ms")
+        print(f"  bundle      : {bundle:8.2f} ms  (1 file open, mmap, {(bundle - loose) / loose:+.0%})")
+    stale = game.BUNDLE.stale
+    if stale:
+        print(f"  {len(stale)} stale entries were read from loose files: {', '.join(stale)}")
+
+
+def bench_background(frames=600):
+    game = load_game()
+    screen = setup_display(game.SCREENRECT.size)
+    bgdtile = game.load_image("utyuu.jpg")
+    background = pg.Surface(game.SCREENRECT.size)
+
+    def full_blits():
+        # 以前のmain()と同じく、毎フレーム背景画像を2回全画面に描く
+        for _ in range(frames):
+            background.blit(bgdtile, (0, 0))
+            screen.blit(background, (0, 0))
+
+    starfield = game.Starfield(game.Starfield.make_strip(bgdtile).convert())
+
+    def scrolling():
+        for _ in range(frames):
+            starfield.clear(screen)
+            starfield.scroll(screen)
+            starfield.draw(screen)
+
+    full_ms = measure(full_blits, 5) / frames
+    scroll_ms = measure(scrolling, 5) / frames
+    print(f"background per frame ({frames} frames):")
+    print(f"  full 640x480 double blit : {full_ms:7.3f} ms")
+    print(f"  starfield (scroll+stars) : {scroll_ms:7.3f} ms  (scrolls every {game.BACKGROUND_SCROLL_INTERVAL} frames)")
+
+
+def bench_pause(seconds=3):
+    game = load_game()
+    screen = setup_display(game.SCREENRECT.size)
+    assets = game.Assets()
+
+    def cpu_usage(paused):
+        g = game.Game(screen, assets)
+        if paused:
+            g.pause("key")
+        pg.time.set_timer(pg.QUIT, seconds * 1000, 1)  # seconds秒後に終了させる
+        wall, cpu = time.perf_counter(), time.process_time()
+        g.run(g.play)
+        return (time.process_time() - cpu) / (time.perf_counter() - wall) * 100
+
+    print(f"CPU usage over {seconds} s:")
+    print(f"  playing : {cpu_usage(False):6.1f} %")
+    print(f"  paused  : {cpu_usage(True):6.1f} %")
+
+
+def bench_arena(repeat=30, sizes=(1600, 6400, 25600), density=0.5):
+    game = load_game()
+    screen = setup_display(game.SCREENRECT.size)
+    assets = game.Assets()
+    rng = random.Random(0)
+    print(f"draw per frame ({density} sprites per 1000 px^2 of arena):")
+    for width in sizes:
+        game.ARENARECT = pg.Rect(0, 0, width, game.SCREENRECT.height)
+        scene = game.Game(screen, assets).play
+        scene.reset()
+        count = int(width * game.ARENARECT.height / 1000 * density)
+        for _ in range(count):
+            pos = (rng.randrange(width), rng.randrange(game.ARENARECT.height))
+            game.Explosion(scene.player, scene.all).rect.center = pos
+        view = scene.camera.view
+
+        def draw_all():
+            # 以前と同じく、全スプライトをアニメーションさせて描く
+            for sprite in scene.all:
+                if hasattr(sprite, "animate"):
+                    sprite.animate()
+            screen.blits([(sprite.image, sprite.rect.move(-view.x, -view.y)) for sprite in scene.all], doreturn=False)
+
+        def draw_culled():
+            scene.cull()
+            screen.blits(scene.sprite_sequence(), doreturn=False)
+
+        all_ms = measure(draw_all, repeat)
+        culled_ms = measure(draw_culled, repeat)
+        print(f"  arena {width:5d}x{game.ARENARECT.height}, {count:5d} sprites ({len(scene.visible)} visible):"
+              f"  all {all_ms:7.2f} ms  culled {culled_ms:7.2f} ms")
+
+
+def bench_fleet(repeat=30, counts=(100, 1000, 5000), shots=20):
+    spec = importlib.util.spec_from_file_location("aliens", os.path.join(main_dir, "aliens.py"))
+    aliens = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(aliens)
+    setup_display(aliens.SCREENRECT.size)
+    aliens.Alien.images = [aliens.load_image(f"alien{i}.gif") for i in (1, 2, 3)]
+    aliens.Shot.images = [aliens.load_image("shot.gif")]
+    rng = random.Random(0)
+    print(f"update + collide with {shots} shots per frame:")
+    for count in counts:
+        shot_group = pg.sprite.Group()
+        for _ in range(shots):
+            aliens.Shot((rng.randrange(640), rng.randrange(480)), shot_group)
+
+        sprites = pg.sprite.Group()
+        with contextlib.redirect_stdout(io.StringIO()):  # Alien()はprintするので黙らせる
+            for _ in range(count):
+                aliens.Alien(sprites).rect.top = rng.randrange(400)
+
+        def step_sprites():
+            sprites.update()
+            pg.sprite.groupcollide(sprites, shot_group, 0, 0)
+
+        fleet = aliens.Fleet()
+        while len(fleet) < count:
+            fleet.spawn_wave()
+        fleet.remove(range(count, len(fleet)))
+
+        def step_fleet():
+            fleet.update()
+            for shot in shot_group:
+                fleet.collide(shot.rect)
+
+        sprite_ms = measure(step_sprites, repeat)
+        fleet_ms = measure(step_fleet, repeat)
+        print(f"  {count:5d} aliens:  sprites {sprite_ms:7.2f} ms  fleet {fleet_ms:7.2f} ms  ({sprite_ms / fleet_ms:4.1f}x)")
+
+
+class SpriteShot(pg.sprite.Sprite):
+    """
+    比較用: Entityにする前のShot(__dict__を持ち、インスタンスごとにマスクを作る)
+    """
+
+    def __init__(self, image, pos, *groups):
+        super().__init__(*groups)
+        self.image = image
+        self.rect = image.get_rect(midbottom=pos)
+        self.mask = pg.mask.from_surface(image)
+        self.angle = 0
+        self.dx = 0
+        self.dy = 0
+
+
+class SpriteBomb(pg.sprite.Sprite):
+    """
+    比較用: Entityにする前のBomb
+    """
+
+    def __init__(self, image, pos, *groups):
+        super().__init__(*groups)
+        self.image = image
+        self.rect = image.get_rect(midtop=pos)
+        self.bomb_angle = 0
+        self.dx = 0
+        self.dy = 0
+
+
+class SpriteItem(pg.sprite.Sprite):
+    """
+    比較用: Entityにする前のItem(インスタンスごとに縮小した画像とマスクを作る)
+    """
+
+    def __init__(self, image, *groups):
+        super().__init__(*groups)
+        self.image = pg.transform.scale(image, (64, 48))
+        self.image.set_colorkey((255, 255, 255))
+        self.rect = self.image.get_rect(topleft=(-100, -100))
+        self.mask = pg.mask.from_surface(self.image)
+        self.speed = random.uniform(1.0, 3.0)
+        self.spawned = False
+
+
+class SpriteExplosion(pg.sprite.Sprite):
+    """
+    比較用: Entityにする前のExplosion
+    """
+
+    def __init__(self, image, actor, *groups):
+        super().__init__(*groups)
+        self.image = image
+        self.rect = image.get_rect(center=actor.rect.center)
+        self.life = 12
+
+
+def entity_memory(game, make, count):
+    """
+    make(groups)でcount個作り、1個あたりのPythonのヒープと常駐メモリの増え方(バイト)を返す
+    """
+    groups = (pg.sprite.Group(), pg.sprite.Group())  # 種類ごとのグループとall
+    tracemalloc.start()
+    rss = game.resident_bytes()
+    heap = tracemalloc.get_traced_memory()[0]
+    entities = [make(groups) for _ in range(count)]
+    heap = tracemalloc.get_traced_memory()[0] - heap
+    rss = game.resident_bytes() - rss
+    tracemalloc.stop()
+    for entity in entities:
+        entity.kill()
+    return heap / count, rss / count
+
+
+def bench_entities(kind=None, variant=None, count=10000):
+    if kind is None:
+        # 前に作って消した分のメモリが次の計測で使い回されないよう、1つずつ新しいプロセスで測る
+        print(f"memory per live entity ({count} entities, each in 2 groups like the game):")
+        print("             python heap (sprite -> entity)       resident (sprite -> entity)")
+        for kind in ("Shot", "Bomb", "Item", "Explosion"):
+            (sprite_heap, sprite_rss), (heap, rss) = (
+                map(float, subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), "entities", kind, variant],
+                    capture_output=True, text=True, check=True,
+                ).stdout.split()[-2:])
+                for variant in ("sprite", "entity")
+            )
+            print(f"  {kind:9s}: {sprite_heap:7.0f} B -> {heap:7.0f} B ({heap / sprite_heap - 1:+4.0%})"
+                  f"     {sprite_rss:7.0f} B -> {rss:7.0f} B ({rss / sprite_rss - 1:+4.0%})")
+        return
+
+    game = load_game()
+    setup_display(game.SCREENRECT.size)
+    game.Assets()
+    path = game.BulletPattern.get(game.PATTERNS["normal"]).path(0, 1)
+    actor = game.Shot((320, 240), path)
+    item_image = game.load_image("item.png")  # Item.prepare()で縮小する前の画像
+    makers = {  # (種類, "sprite"は以前の形・"entity"は今の形) -> make(groups)
+        ("Shot", "sprite"): lambda groups: SpriteShot(game.Shot.images[0], (320, 240), *groups),
+        ("Shot", "entity"): lambda groups: game.Shot((320, 240), path, *groups),
+        ("Bomb", "sprite"): lambda groups: SpriteBomb(game.Bomb.images[0], (320, 240), *groups),
+        ("Bomb", "entity"): lambda groups: game.Bomb((320, 240), path, *groups),
+        ("Item", "sprite"): lambda groups: SpriteItem(item_image, *groups),
+        ("Item", "entity"): lambda groups: game.Item(*groups),
+        ("Explosion", "sprite"): lambda groups: SpriteExplosion(game.Explosion.images[0], actor, *groups),
+        ("Explosion", "entity"): lambda groups: game.Explosion(actor, *groups),
+    }
+    heap, rss = entity_memory(game, makers[kind, variant], count)
+    print(f"{heap:.1f} {rss:.1f}")
+
+
+def bench_patterns(repeat=30, counts=(500, 2000, 8000), ticks=60):
+    game = load_game()
+    setup_display(game.SCREENRECT.size)
+    game.Assets()
+    game.ARENARECT = pg.Rect(0, 0, 100000, 100000)  # 計測中に弾が場の外へ出て消えないよう広くする
+    definition = {"shape": "ring", "count": 50, "speed": 1, "accel": 0.05, "max_speed": 6, "curve": 2}
+    pattern = game.BulletPattern.get(definition)
+    speed, accel, limit, curve = pattern.motion
+
+    class TrigShot(game.Entity):
+        # 以前のShotのように、毎フレーム速さと向きから移動量を計算する弾
+        __slots__ = ("x", "y", "speed", "heading")
+
+        def __init__(self, pos, heading, *groups):
+            game.Entity.__init__(self, *groups)
+            self.image = game.Shot.images[0]
+            self.rect = self.image.get_rect(center=pos)
+            self.x, self.y = pos
+            self.speed = speed
+            self.heading = heading
+
+        def update(self):
+            self.x += self.speed * math.sin(math.radians(self.heading))
+            self.y -= self.speed * math.cos(math.radians(self.heading))
+            self.rect.center = (round(self.x), round(self.y))
+            self.speed = min(self.speed + accel, limit)
+            self.heading += curve
+
+    pos = (50000, 50000)
+    compile_ms = measure(pattern.precompile, 1)  # キャラクターパックを読み込むときに行う分
+    print(f"precompiled {len(pattern.paths)} trajectories (both directions) in {compile_ms:.1f} ms")
+    print(f"update per tick, {definition['count']}-way ring curving and accelerating:")
+    for count in counts:
+        volleys = count // definition["count"]
+        trig = pg.sprite.Group()
+        for volley in range(volleys):
+            for angle in pattern.angles(pos, -1, volley):
+                TrigShot(pos, angle, trig)
+        table = pg.sprite.Group()
+        for volley in range(volleys):
+            pattern.fire(game.Shot, pos, (table,), volley)
+
+        def run(group):
+            def ticks_of():
+                for _ in range(ticks):
+                    group.update()
+            return ticks_of
+
+        trig_ms = measure(run(trig), repeat // 10 or 1) / ticks
+        table_ms = measure(run(table), repeat // 10 or 1) / ticks
+        print(f"  {count:5d} projectiles:  trig {trig_ms:7.3f} ms  table {table_ms:7.3f} ms  ({trig_ms / table_ms:4.1f}x)")
+
+
+def bench_present(frames=200, scales=(1, 2, 3, 4)):
+    game = load_game()
+    setup_display(game.SCREENRECT.size)
+    assets = game.Assets()
+    print(f"present per frame ({frames} frames of play):")
+    for scale in scales:
+        presenter = game.Presenter.open("integer", scale)
+        g = game.Game(presenter.surface, assets, presenter=presenter)
+        g.change(g.play)
+        g.play.player.speed = 8  # カメラと星が動いて、実際の対戦に近い範囲を更新するように動かし続ける
+        for _ in range(frames):
+            g.play.update()
+            g.play.draw(g.screen)
+        g.scene.exit()
+        stats = presenter.stats
+        play_ms = stats["total_ms"] / stats["frames"]
+        full_ms = measure(presenter.present, 30)
+        width, height = presenter.display.get_size()
+        print(f"  {width:4d}x{height:<4d} (x{scale}): play frame avg {play_ms:6.3f} ms  max {stats['max_ms']:6.3f} ms"
+              f"  whole screen {full_ms:6.3f} ms")
+
+
+def bench_startup(repeat=10):
+    # 起動時間はimportから測るので、毎回新しいプロセスで起動する
+    pattern = re.compile(r"startup: first frame ([\d.]+) ms, playable ([\d.]+) ms")
+    first_frames, playables = [], []
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, os.path.join(main_dir, "suta-_koukaton.py"), "--startup"],
+            capture_output=True, text=True, check=True,
+        )
+        match = pattern.search(result.stdout)
+        if match is None:
+            raise SystemExit(f"no startup report in the output:\n{result.stdout}{result.stderr}")
+        first_frames.append(float(match.group(1)))
+        playables.append(float(match.group(2)))
+    print(f"startup ({repeat} runs, from the start of import):")
+    for name, times in (("first frame", first_frames), ("playable", playables)):
+        print(f"  {name:12s}: median {statistics.median(times):7.1f} ms  min {min(times):7.1f} ms  max {max(times):7.1f} ms")
+    print(result.stdout[match.start():].rstrip())  # 最後の1回の内訳
+
+
+def bench_history(matches=300000, repeat=50):
+    game = load_game()
+    rng = random.Random(0)
+    characters = [f"chara{i:02d}" for i in range(20)]
+
+    def synthetic(played_at):
+        match = {column: rng.randrange(30) for column in game.MatchHistory.COLUMNS}
+        match.update(
+            played_at=played_at, duration_ms=rng.randrange(5000, 120000), winner=rng.choice(game.MatchHistory.SIDES),
+            player=rng.choice(characters), alien=rng.choice(characters),
+        )
+        return match
+
+    with tempfile.TemporaryDirectory() as folder:
+        history = game.MatchHistory(os.path.join(folder, "history.sqlite3"))
+        db = sqlite3.connect(history.path)
+        start = time.perf_counter()
+        for first in range(0, matches, 10000):
+            game.MatchHistory.write(db, [synthetic(i) for i in range(first, first + 10000)])
+        db.close()
+        print(f"filled {matches} matches in {time.perf_counter() - start:.1f} s")
+
+        print("query:")
+        queries = (
+            ("leaderboard(10)", lambda: history.leaderboard(10)),
+            ("character_stats", lambda: history.character_stats(rng.choice(characters))),
+            ("high_scores(10)", lambda: history.high_scores("Player", 10)),
+        )
+        for label, query in queries:
+            print(f"  {label:16s}: {measure(query, repeat):7.3f} ms")
+
+        def write():
+            history.record(synthetic(time.time()))
+            history.flush()
+
+        print(f"write 1 match (record + flush): {measure(write, repeat):7.3f} ms")
+        start = time.perf_counter()
+        for _ in range(repeat):
+            history.record(synthetic(time.time()))
+        record_ms = (time.perf_counter() - start) * 1000 / repeat
+        print(f"record() on the game thread   : {record_ms:7.3f} ms")
+        history.close()
+
+
+def main(argv):
+    commands = {
+        "atlas": bench_atlas, "bundle": bench_bundle, "background": bench_background, "pause": bench_pause,
+        "arena": bench_arena, "fleet": bench_fleet, "entities": bench_entities,
+        "patterns": bench_patterns, "present": bench_present, "startup": bench_startup,
+        "history": bench_history,
+    }
+    if len(argv) < 2 or argv[1] not in commands:
+        raise SystemExit(__doc__)
+    commands[argv[1]](*argv[2:])  # 追加の引数はbench.py自身が子プロセスに渡すときだけ使う
+    pg.quit()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
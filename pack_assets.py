@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+"""
+ゲームの素材をまとめるためのオフラインツール
+
+使い方:
+    python pack_assets.py atlas    data/ と fig/ の小さな画像を data/atlas.png と data/atlas.json にまとめる
+    python pack_assets.py bundle   data/ fig/ characters/ の素材を assets.bundle の1ファイルにまとめる
+
+素材を追加・変更したら実行し直すこと(bundleはatlasの後に作る)。
+"""
+
+import json
+import os
+import struct
+import sys
+
+import pygame as pg
+
+main_dir = os.path.split(os.path.abspath(__file__))[0]
+
+ATLAS_SOURCES = ("data", "fig")  # アトラスにまとめる画像のフォルダ
+ATLAS_EXTENSIONS = (".png", ".gif")
+ATLAS_MAX_SIZE = 512  # これより大きい画像(背景など)はアトラスに入れない
+ATLAS_WIDTH = 512
+ATLAS_PADDING = 1
+ATLAS_IMAGE = os.path.join(main_dir, "data", "atlas.png")
+ATLAS_INDEX = os.path.join(main_dir, "data", "atlas.json")
+
+BUNDLE_SOURCES = ("data", "fig", "characters")  # バンドルにまとめるフォルダ
+BUNDLE_SKIP = ("desktop.ini",)
+BUNDLE_FILE = os.path.join(main_dir, "assets.bundle")
+BUNDLE_MAGIC = b"KOUKATON-BUNDLE1"  # suta-_koukaton.py と同じ値にする
+BUNDLE_ALIGN = 16
+
+
+def atlas_sources():
+    """
+    アトラスに入れる画像を読み込み、(名前, Surface)のリストを返す
+    名前はmain_dirからの相対パス("data/3.png"など)で、ゲーム側のload_imageと同じ規則にする。
+    """
+    sources = []
+    for folder in ATLAS_SOURCES:
+        for file in sorted(os.listdir(os.path.join(main_dir, folder))):
+            name = f"{folder}/{file}"
+            path = os.path.join(main_dir, folder, file)
+            if not file.lower().endswith(ATLAS_EXTENSIONS) or os.path.abspath(path) == ATLAS_IMAGE:
+                continue
+            try:
+                surface = pg.image.load(path)
+            except pg.error:
+                print(f"skip {name}: {pg.get_error()}")
+                continue
+            if max(surface.get_size()) > ATLAS_MAX_SIZE:
+                print(f"skip {name}: too large {surface.get_size()}")
+                continue
+            sources.append((name, surface))
+    return sources
+
+
+def shelf_pack(sizes, width=ATLAS_WIDTH, padding=ATLAS_PADDING):
+    """
+    高さの大きい順に棚(shelf)へ左から詰めていく単純な配置
+    引数: sizes : List[Tuple[int, int]] : 各画像の(幅, 高さ)
+    戻り値: (各画像の左上座標のリスト, アトラスの高さ)
+    """
+    width = max([width] + [w for w, _ in sizes])
+    order = sorted(range(len(sizes)), key=lambda i: (-sizes[i][1], -sizes[i][0]))
+    positions = [None] * len(sizes)
+    x = y = shelf_height = 0
+    for i in order:
+        w, h = sizes[i]
+        if x + w > width:
+            x = 0
+            y += shelf_height + padding
+            shelf_height = 0
+        positions[i] = (x, y)
+        x += w + padding
+        shelf_height = max(shelf_height, h)
+    return positions, y + shelf_height
+
+
+def build_atlas():
+    """
+    アトラス画像とその索引(名前 -> 矩形と透明色)を書き出す
+    load_image()と同じく、アルファは捨ててRGBの値をそのまま写す。
+    """
+    sources = atlas_sources()
+    sizes = [surface.get_size() for _, surface in sources]
+    positions, height = shelf_pack(sizes)
+    width = max(x + w for (x, _), (w, _) in zip(positions, sizes))
+    atlas = pg.Surface((width, height), 0, 24)
+    index = {}
+    for (name, surface), pos in zip(sources, positions):
+        colorkey = surface.get_colorkey()
+        surface.set_colorkey(None)
+        surface.set_alpha(None)  # 画素ごとのアルファも含めて合成せずにそのまま写す
+        atlas.blit(surface, pos)
+        index[name] = {
+            "rect": [pos[0], pos[1], *surface.get_size()],
+            "colorkey": list(colorkey[:3]) if colorkey else None,
+        }
+    pg.image.save(atlas, ATLAS_IMAGE)
+    with open(ATLAS_INDEX, "w", encoding="utf-8") as f:
+        lines = [f"  {json.dumps(name)}: {json.dumps(entry)}" for name, entry in index.items()]
+        f.write("{\n" + ",\n".join(lines) + "\n}\n")
+    print(f"packed {len(index)} images into {width}x{height} {os.path.relpath(ATLAS_IMAGE, main_dir)}")
+
+
+def build_bundle():
+    """
+    素材ファイルを1つにまとめたバンドルを書き出す
+    書式: BUNDLE_MAGIC, 索引の長さ(uint32 little endian), 索引(json: 名前 -> [offset, size]), 各ファイルの中身
+    offsetは索引の直後からの位置で、各ファイルの先頭はそこからBUNDLE_ALIGNバイト境界にそろえる。
+    """
+    index = {}
+    chunks = []
+    offset = 0
+    for folder in BUNDLE_SOURCES:
+        for file in sorted(os.listdir(os.path.join(main_dir, folder))):
+            path = os.path.join(main_dir, folder, file)
+            if file in BUNDLE_SKIP or not os.path.isfile(path):
+                continue
+            with open(path, "rb") as f:
+                data = f.read()
+            padding = -offset % BUNDLE_ALIGN
+            chunks.append(b"\0" * padding + data)
+            offset += padding
+            index[f"{folder}/{file}"] = [offset, len(data)]
+            offset += len(data)
+    header = json.dumps(index, separators=(",", ":")).encode("utf-8")
+    with open(BUNDLE_FILE, "wb") as f:
+        f.write(BUNDLE_MAGIC)
+        f.write(struct.pack("<I", len(header)))
+        f.write(header)
+        for chunk in chunks:
+            f.write(chunk)
+    print(f"bundled {len(index)} files ({offset} bytes) into {os.path.relpath(BUNDLE_FILE, main_dir)}")
+
+
+def main(argv):
+    commands = {"atlas": build_atlas, "bundle": build_bundle}
+    if len(argv) != 2 or argv[1] not in commands:
+        raise SystemExit(__doc__)
+    commands[argv[1]]()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -1,12 +1,40 @@
 #!/usr/bin/env python
+import time
+
+STARTUP_MARKS = [("start", time.perf_counter(), "")]  # 起動時間の計測(importにかかった時間も含めるため最初に記録する)
+
+import gc
+import io
+import json
+import linecache
+import mmap
 import os
+import queue
 import random
 import math
-from typing import List
+import statistics
+import struct
+import sys
+import threading
+import tracemalloc
+import weakref
+from array import array
+from collections import OrderedDict, deque
+from operator import neg
+from typing import Dict, List
+
+STARTUP_MARKS.append(("import stdlib", time.perf_counter(), ""))
 
 # import basic pygame modules
 import pygame as pg
 
+STARTUP_MARKS.append(("import pygame", time.perf_counter(), ""))
+
+try:
+    import sqlite3
+except ImportError:  # sqlite3無しでビルドされたPythonでは対戦の記録を残さない
+    sqlite3 = None
+
 # see if we can load more than standard BMP
 if not pg.image.get_extended():
     raise SystemExit("Sorry, extended image module required")
@@ -15,43 +43,537 @@ if not pg.image.get_extended():
 MAX_SHOTS = 10  # most player bullets onscreen
 MAX_BOMBS = 10
 SCREENRECT = pg.Rect(0, 0, 640, 480)
+ARENARECT = pg.Rect(0, 0, 1600, 480)  # 対戦の場の広さ。画面より広い分はカメラで追って映す
 PLAYER_SCORE = 0
 ALIEN_SCORE = 0
+PAUSED_TIME = 0  # 一時停止していた時間の合計(ms)
 MAX_ITEMS_ON_SCREEN = 4 #最大(n-1)つまで画面にitemを表示可能
 ITEM_SPAWN_INTERVAL = random.randint(5000, 15000)
+WIN_SCREEN_TIME = 5000  # 勝利画面を表示する時間(ms)
+REMATCH_GUARD_TIME = 500  # 勝利画面で再戦キーを受け付けるまでの時間(ms)
+MIXER_FREQUENCY = 44100
+MIXER_BUFFER = 1024  # ミキサーのバッファ(サンプル数)。遅延はおよそ MIXER_BUFFER / MIXER_FREQUENCY 秒
+SOUND_CHANNELS = 8  # 効果音用に予約するチャンネル数
+SOUND_MIN_INTERVAL = 50  # 同じ効果音を続けて鳴らすまでの最小間隔(ms)
+SOUND_PRIORITY_SHOT = 1  # 効果音の優先度(大きいほど優先され、他の音を止めてでも鳴る)
+SOUND_PRIORITY_SPECIAL = 2
+SOUND_PRIORITY_ITEM = 2
+SOUND_PRIORITY_EXPLOSION = 3
+MUSIC_FADE_TIME = 300  # 決着時にBGMをフェードアウトする時間(ms)
+FINISH_TIME = 1000  # 決着してから勝利画面に切り替えるまで爆発を見せる時間(ms)
+MAX_PARTICLES = 4000  # 同時に出せるパーティクルの最大数
+PARTICLE_MIN_LIMIT = 200  # 負荷が高いときでも出せるパーティクルの数
+PARTICLE_TIME_BUDGET = 6.0  # パーティクルの更新と描画にかけてよい時間(ms/フレーム)
+BACKGROUND_SCROLL_INTERVAL = 3  # 一番奥の背景を1ピクセル流す間隔(フレーム)
+SIMULATION_RATE = 40  # 別スレッドでシミュレーションするときの1秒あたりのティック数
+FRAME_RATE = 40  # メインループの1秒あたりのフレーム数
+FRAME_BUSY_HEADROOM = 0.5  # 処理時間がフレームの予算のこの割合未満なら、ビジーループで正確に待つ
+QUALITY_DOWN_FRAMES = 20  # 予算を超えたフレームがこれだけ続いたら品質を1段下げる
+QUALITY_UP_FRAMES = 200  # 処理時間が予算のQUALITY_UP_RATIO未満のフレームがこれだけ続いたら品質を1段上げる
+QUALITY_UP_RATIO = 0.6
+DISPLAY_SCALE = 2  # --scale で数を省いたときの拡大率
+INPUT_BUFFER_SIZE = 256  # ためておけるキーのイベントの数(対戦中以外は古いものから捨てる)
+FRAME_WAKE_MARGIN = 0.001  # 次のフレームの時刻のこれだけ前に眠りから覚め、残りはclockで合わせる(秒)
+INPUT_POLL_INTERVAL = 0.003  # フレームの待ち時間に、キーのイベントを受け取って時刻を付ける間隔(秒)
+LATENCY_SAMPLES = 1000  # 入力の遅れを覚えておく数
+QUALITY_LEVELS = (  # (名前, パーティクルの上限の割合, 描く星の層の数, 奥の背景を流すか, HUDを更新する間隔(ティック), 効果音の同時発音数)
+    ("high", 1.0, 3, True, 1, SOUND_CHANNELS),
+    ("medium", 0.5, 2, True, 2, 6),
+    ("low", 0.25, 1, False, 4, 4),
+    ("minimal", 0.1, 0, False, 8, 2),
+)
+CAMERA_FOLLOW_RATE = 0.15  # カメラが1フレームで目標位置へ寄る割合
+CULL_CELL_SIZE = 128  # 画面外のスプライトを間引くための格子の1マスの大きさ(ピクセル)
+MEMORY_SAMPLE_INTERVAL = 1000  # --memoryのときにメモリ使用量を記録する間隔(ms)
+MEMORY_MAX_SAMPLES = 3600  # 記録を残しておく数(古いものから捨てる)
+MEMORY_TRACE_FRAMES = 10  # tracemallocが確保した場所として覚える呼び出しの深さ
+MEMORY_GROWTH_MATCHES = 3  # この回数の対戦で続けて増えたらリークの疑いとして知らせる
+MEMORY_GROWTH_THRESHOLD = 64 * 1024  # 対戦1回あたりこれ(バイト)より増えたら「増えた」とみなす
+EVENT_LOG_CAPACITY = 4096  # 書き出し待ちにしておける出来事の数(あふれた分は捨てる)
+EVENT_LOG_FLUSH_INTERVAL = 0.5  # 出来事のログをファイルに書き出す間隔(秒)
+PATTERN_ANGLE_STEP = 1  # 弾の軌道表を共有するために向きをそろえる刻み(度)
+PATTERN_MAX_TICKS = 1200  # 弾の軌道表の最大の長さ(ティック)。遅い弾もこれで消える
+PATTERN_AIM_LIMIT = 80  # aimedで狙える向きの正面からの最大の角度(度)。左右にしか動かないので実際はこれより内側になる
+PATTERNS = {  # 弾の撃ち方の定義。キャラクターパックのjsonの"patterns"で種類ごとに置き換えられる
+    "normal": {"shape": "fan", "count": 1, "speed": 3},
+    "spread": {"shape": "fan", "count": 3, "spread": 18, "speed": 3.16},  # 横に約1、縦に約3ずつ進む3方向
+    "speed": {"shape": "fan", "count": 1, "speed": 15},
+}
 
 
 main_dir = os.path.split(os.path.abspath(__file__))[0]
+BUNDLE_FILE = os.path.join(main_dir, "assets.bundle")  # pack_assets.py bundle で作る素材ファイル
+BUNDLE_MAGIC = b"KOUKATON-BUNDLE1"
+EVENT_LOG_FILE = os.path.join(main_dir, "events.jsonl")  # --log のときに出来事を書き足すファイル
+HISTORY_FILE = os.path.join(main_dir, "history.sqlite3")  # 対戦の記録を残すデータベース
+CHARACTER_DIR = "characters"  # キャラクターパック(json)の置き場所
+CHARACTER_CACHE_SIZE = 4  # メモリに保持するキャラクターパックの最大数
+DEFAULT_CHARACTERS = {"Player": "koukaton", "Alien": "alien"}  # 最初に選ばれているキャラクター(無ければ一覧の先頭)
+THUMBNAIL_SIZE = (64, 64)  # 選択画面のサムネイルの大きさ
+PRELOAD_FONTS = ((20, True), (25, False), (28, False), (32, False), (64, False), (80, False))  # 起動時に読み込むフォント(大きさ, 斜体)
+SPLASH_BAR_SIZE = (320, 12)  # 起動画面の読み込みの進み具合を表すバーの大きさ
+
+
+def resident_bytes():
+    """
+    プロセスの常駐メモリ(バイト)を返す。/proc が無い環境では0
+    SDLが確保するSurfaceの画素やマスクはtracemallocに映らないので、こちらで見る。
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return 0
 
 
-def load_image(file):
-    """loads an image, prepares it for play"""
-    file = os.path.join(main_dir, "data", file)
+class EventLog:
+    """
+    対戦中の出来事(発射・命中・アイテム取得・ゲージの変化など)と警告を1行1件のjsonで書き出すログ
+    log()はメモリ上のバッファ(最大EVENT_LOG_CAPACITY件)に積むだけで、jsonへの変換と
+    ファイルへの書き込みは別スレッドがEVENT_LOG_FLUSH_INTERVALごとにまとめて行うので、フレームを止めない。
+    バッファがあふれたときは待たずに捨て、捨てた数をdroppedに数える。
+    open()するまではlog()は何もしない。
+    """
+
+    def __init__(self, capacity=EVENT_LOG_CAPACITY):
+        self.capacity = capacity
+        self.buffer = deque()
+        self.dropped = 0
+        self.written = 0
+        self.file = None
+        self.thread = None
+        self.wakeup = threading.Event()
+        self.stopped = False
+
+    def open(self, path=EVENT_LOG_FILE):
+        self.file = open(path, "a", encoding="utf-8")
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def log(self, event, tick=None, **fields):
+        """
+        出来事を記録する。tickは対戦が始まってからのティック数(対戦の外ならNone)
+        """
+        if self.file is None:
+            return
+        buffer = self.buffer
+        if len(buffer) >= self.capacity:
+            self.dropped += 1
+            return
+        buffer.append((time.time(), tick, event, fields))
+        if len(buffer) >= self.capacity // 2:
+            self.wakeup.set()  # 次の書き出しを待たずに書く
+
+    def run(self):
+        while not self.stopped:
+            self.wakeup.wait(EVENT_LOG_FLUSH_INTERVAL)
+            self.wakeup.clear()
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        """
+        バッファにたまっている出来事をまとめて書き出す(書き出し用のスレッドから呼ぶ)
+        """
+        buffer = self.buffer
+        lines = []
+        while buffer:
+            when, tick, event, fields = buffer.popleft()
+            record = {"time": round(when, 3), "tick": tick, "event": event}
+            record.update(fields)
+            lines.append(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+        if lines:
+            self.file.write("\n".join(lines) + "\n")
+            self.file.flush()
+            self.written += len(lines)
+
+    def close(self):
+        if self.file is None:
+            return
+        self.stopped = True
+        self.wakeup.set()
+        self.thread.join()
+        self.file.close()
+        self.file = None
+
+    def report(self):
+        return f"event log: {self.written} events written, {self.dropped} dropped"
+
+
+EVENTS = EventLog()
+
+
+def warn(message):
+    """
+    警告を標準エラー出力に出し、出来事のログ(開いていれば)にも"warning"として書く
+    """
+    print(f"Warning, {message}", file=sys.stderr)
+    EVENTS.log("warning", message=message)
+
+
+def get_ticks():
+    """
+    一時停止していた時間を除いた経過時間(ms)を返す
+    ゲージやアイテムのタイマーはこれを使うので、一時停止から戻っても時間が飛ばない。
+    """
+    return pg.time.get_ticks() - PAUSED_TIME
+
+
+class StartupTimer:
+    """
+    起動にかかった時間を段階ごとに記録するクラス
+    時刻はimportの始めからの経過時間で、最初の画面を出すまで(first frame)と、
+    タイトル画面で操作できるようになるまで(playable)を分けて表示する。
+    同じ名前の段階は最初の1回だけを記録する。読み込みスレッドの結果も表示と同じスレッドで記録する。
+    """
+
+    def __init__(self, marks):
+        self.marks = list(marks)  # (段階の名前, 終わった時刻, 補足)
+        self.names = {name for name, _, _ in self.marks}
+
+    def mark(self, name, detail=""):
+        if name not in self.names:
+            self.names.add(name)
+            self.marks.append((name, time.perf_counter(), detail))
+
+    def elapsed(self, name):
+        """
+        nameの段階が終わるまでの時間(ms)。まだならNone
+        """
+        started = self.marks[0][1]
+        for mark, at, _ in self.marks:
+            if mark == name:
+                return (at - started) * 1000
+        return None
+
+    def report(self):
+        first_frame = self.elapsed("first frame")
+        playable = self.elapsed("playable")
+        lines = [
+            f"startup: first frame {first_frame or 0:.1f} ms, playable {playable or 0:.1f} ms (from the start of import)"
+        ]
+        started = previous = self.marks[0][1]
+        for name, at, detail in self.marks[1:]:
+            line = f"  {(at - started) * 1000:8.1f} ms  +{(at - previous) * 1000:6.1f} ms  {name}"
+            lines.append(f"{line} ({detail})" if detail else line)
+            previous = at
+        return "\n".join(lines)
+
+
+STARTUP = StartupTimer(STARTUP_MARKS)
+FONTS: Dict[tuple, "pg.font.Font"] = {}  # (大きさ, 斜体) -> 読み込み済みのフォント
+
+
+def get_font(size, italic=False):
+    """
+    既定のフォントを返す。大きさと斜体の組ごとに一度だけ読み込んで使い回す
+    """
+    key = (size, italic)
+    font = FONTS.get(key)
+    if font is None:
+        font = pg.font.Font(None, size)
+        font.set_italic(italic)
+        FONTS[key] = font
+    return font
+
+
+class BundleFile(io.RawIOBase):
+    """
+    バンドル内の1ファイル分の範囲を読むためのファイルオブジェクト
+    mmapのmemoryviewから必要な分だけを読み出すので、ファイル全体をコピーしない。
+    """
+
+    def __init__(self, view):
+        super().__init__()
+        self.view = view
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = max(0, min(len(buffer), len(self.view) - self.pos))
+        buffer[:size] = self.view[self.pos:self.pos + size]
+        self.pos += size
+        return size
+
+    def readall(self):
+        # read()で全部を読むときに、既定の実装のように小分けにしてreadintoを繰り返さない
+        data = bytes(self.view[self.pos:])
+        self.pos = len(self.view)
+        return data
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        self.pos = max(0, offset)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+
+class Bundle:
+    """
+    pack_assets.py bundle で作った1つの素材ファイルをmmapして中身を渡すクラス
+    書式: BUNDLE_MAGIC, 索引の長さ(uint32 little endian), 索引(json: 名前 -> [offset, size]), 各ファイルの中身
+    offsetは索引の直後からの位置。
+    起動時に開くのはこのファイル1つだけで、デコードはmmapした領域から直接行う。
+    ファイルが無い場合は空として扱い、個別ファイルから読む(開発用)。
+    バンドルを作った後に個別ファイルの方が変更された(新しい、または大きさが違う)素材は、
+    古いバンドルの中身ではなく個別ファイルから読み、staleに名前を残す。
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.index: Dict[str, List[int]] = None
+        self.data = None
+        self.base = 0
+        self.mtime = 0.0  # バンドルを作った時刻
+        self.stale: List[str] = []  # バンドルより個別ファイルが新しかった素材
+
+    def load(self):
+        self.index = {}
+        if not os.path.exists(self.file):
+            return
+        with open(self.file, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        start = len(BUNDLE_MAGIC) + 4
+        if data[:len(BUNDLE_MAGIC)] != BUNDLE_MAGIC:
+            data.close()
+            warn(f"not an asset bundle, {self.file}")
+            return
+        self.mtime = os.path.getmtime(self.file)
+        (size,) = struct.unpack_from("<I", data, len(BUNDLE_MAGIC))
+        self.index = json.loads(data[start:start + size].decode("utf-8"))
+        self.data = memoryview(data)
+        self.base = start + size
+
+    def open(self, name):
+        """
+        名前("data/3.png"など)のファイルオブジェクトを返す。バンドルに無ければNone
+        """
+        if self.index is None:
+            self.load()
+        entry = self.index.get(name)
+        if entry is None:
+            return None
+        offset, size = entry
+        try:
+            stat = os.stat(os.path.join(main_dir, *name.split("/")))
+        except OSError:
+            stat = None  # 個別ファイルが無いのは配布用の普通の形
+        if stat is not None and (stat.st_mtime > self.mtime or stat.st_size != size):
+            if name not in self.stale:
+                self.stale.append(name)
+                warn(f"{name} is newer than {os.path.basename(self.file)}, run 'python pack_assets.py bundle'")
+            return None
+        offset += self.base
+        return BundleFile(self.data[offset:offset + size])
+
+    def names(self, folder):
+        """
+        folder直下にあるファイルの名前を返す
+        """
+        if self.index is None:
+            self.load()
+        return [name for name in self.index if name.rpartition("/")[0] == folder]
+
+
+BUNDLE = Bundle(BUNDLE_FILE)
+
+
+def find_asset(name):
+    """
+    素材をバンドルから探し、無ければ個別ファイルのパスを返す
+    戻り値はpg.image.loadやpg.mixer.Soundにそのまま渡せる。
+    """
+    asset = BUNDLE.open(name)
+    if asset is None:
+        asset = os.path.join(main_dir, *name.split("/"))
+    return asset
+
+
+def open_asset(name):
+    """
+    テキストの素材(json)をバンドルか個別ファイルから開く
+    """
+    asset = find_asset(name)
+    if isinstance(asset, str):
+        return open(asset, encoding="utf-8")
+    return io.TextIOWrapper(asset, encoding="utf-8")
+
+
+def list_assets(folder):
+    """
+    folder直下の素材の名前をバンドルと個別ファイルの両方から集めて返す
+    """
+    names = set(BUNDLE.names(folder))
+    path = os.path.join(main_dir, folder)
+    if os.path.isdir(path):
+        names.update(f"{folder}/{file}" for file in os.listdir(path))
+    return sorted(names)
+
+
+def asset_name(file, folder):
+    return "/".join(part for part in (folder, file) if part)
+
+
+class Atlas:
+    """
+    pack_assets.py で作ったアトラス画像から小さな画像を切り出して渡すクラス
+    アトラスは最初に使われたとき(起動時はAssetsの読み込み)に一度だけ読み込んでconvertし、
+    各画像はそのsubsurfaceとして返すので、ファイルを開くのは1回で済み、描画時のメモリも1か所にまとまる。
+    アトラスが無い、または載っていない画像の場合はNoneを返す(個別ファイルから読む)。
+    """
+
+    def __init__(self, image_file, index_file):
+        self.image_file = image_file
+        self.index_file = index_file
+        self.index: Dict[str, dict] = None
+        self.surface = None
+
+    def decode(self):
+        """
+        索引を読み、アトラス画像をデコードして返す。convertはしないので別スレッドから呼んでよい
+        戻り値: (索引, Surface)。アトラスが無ければ({}, None)
+        """
+        try:
+            with open_asset(self.index_file) as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return {}, None
+        try:
+            return index, pg.image.load(find_asset(self.image_file), self.image_file)
+        except (pg.error, FileNotFoundError):
+            warn(f"unable to load, {self.image_file}")
+            return {}, None
+
+    def load(self, decoded=None):
+        """
+        decode()の結果(省略したらここでデコードする)をconvertして使えるようにする
+        """
+        self.index, surface = decoded or self.decode()
+        self.surface = surface.convert() if surface is not None else None
+
+    def get(self, name):
+        """
+        名前("data/3.png"など)に対応するsubsurfaceを返す
+        呼び出し側が透明色を変えても他に影響しないよう、毎回新しいsubsurfaceを作る。
+        """
+        if self.index is None:
+            self.load()
+        entry = self.index.get(name)
+        if entry is None:
+            return None
+        surface = self.surface.subsurface(entry["rect"])
+        if entry["colorkey"] is not None:
+            surface.set_colorkey(entry["colorkey"])
+        return surface
+
+
+ATLAS = Atlas("data/atlas.png", "data/atlas.json")
+
+
+def decode_image(file, folder="data"):
+    """
+    画像ファイルをデコードだけして返す。convertはしないので別スレッドから呼んでよい
+    """
+    name = asset_name(file, folder)
     try:
-        surface = pg.image.load(file)
+        return pg.image.load(find_asset(name), name)
     except pg.error:
-        raise SystemExit(f'Could not load image "{file}" {pg.get_error()}')
-    return surface.convert()
+        raise SystemExit(f'Could not load image "{name}" {pg.get_error()}')
 
 
-def load_sound(file):
+def load_image(file, folder="data"):
+    """loads an image, prepares it for play"""
+    surface = ATLAS.get(asset_name(file, folder))
+    if surface is not None:
+        return surface
+    return decode_image(file, folder).convert()
+
+
+def load_sound(file, folder="data"):
     """because pygame can be compiled without mixer."""
     if not pg.mixer:
         return None
-    file = os.path.join(main_dir, "data", file)
+    name = asset_name(file, folder)
+    file = find_asset(name)
     try:
-        sound = pg.mixer.Sound(file)
+        sound = pg.mixer.Sound(file=file)
         return sound
     except pg.error:
-        print(f"Warning, unable to load, {file}")
+        warn(f"unable to load, {name}")
     return None
 
 
+class Entity:
+    """
+    大量に作られる弾・爆弾・アイテム・爆発のための軽いスプライトの基底クラス
+    pg.sprite.Spriteはインスタンスごとに__dict__と所属グループのsetを持つが、
+    Entityは属性を__slots__に固定し、所属グループは小さなtupleで持つ。
+    pg.sprite.Groupや当たり判定(spritecollideなど)からはSpriteと同じように扱える。
+    サブクラスも__slots__を書いて、インスタンスごとの属性だけを並べること。
+    全インスタンスで共通の画像やマスクはクラス属性に置く。
+    """
+
+    __slots__ = ("image", "rect", "_groups")
+
+    def __init__(self, *groups):
+        self._groups = ()
+        if groups:
+            self.add(*groups)
+
+    def add(self, *groups):
+        for group in groups:
+            if group not in self._groups:
+                group.add_internal(self)
+                self.add_internal(group)
+
+    def remove(self, *groups):
+        for group in groups:
+            if group in self._groups:
+                group.remove_internal(self)
+                self.remove_internal(group)
+
+    def add_internal(self, group):
+        self._groups += (group,)
+
+    def remove_internal(self, group):
+        self._groups = tuple(g for g in self._groups if g is not group)
+
+    def update(self, *args, **kwargs):
+        pass
+
+    def kill(self):
+        for group in self._groups:
+            group.remove_internal(self)
+        self._groups = ()
+
+    def alive(self):
+        return bool(self._groups)
+
+    def groups(self):
+        return list(self._groups)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} Entity(in {len(self._groups)} groups)>"
+
+
 class Gauge(pg.sprite.Sprite):
     """
     ゲージを管理して表示するクラス
     """
 
+    image_is_mutable = True  # update()でimageに直接描き直すので、スナップショットではコピーする
+
     def __init__(self, position, *groups):
         super().__init__(*groups)
         self.image = pg.Surface((50, 100))
@@ -62,8 +584,8 @@ class Gauge(pg.sprite.Sprite):
         self.current_value = 0  # 現在のゲージの量
         self.fill_color = (0, 255, 0)  # ゲージの満タン時の色
         self.empty_color = (255, 0, 0)  # ゲージの空の時の色
-        self.last_update = pg.time.get_ticks()  # 前回ゲージが更新された時間
-        self.font = pg.font.Font(None, 25)  # 数字表示用のフォント
+        self.last_update = get_ticks()  # 前回ゲージが更新された時間
+        self.font = get_font(25)  # 数字表示用のフォント
 
     def update(self):
         """
@@ -84,7 +606,7 @@ class Gauge(pg.sprite.Sprite):
         """
         2秒ごとにゲージを1増やす
         """
-        now = pg.time.get_ticks()
+        now = get_ticks()
         if now - self.last_update > 2000:  # 2秒経過したら
             self.last_update = now
             self.current_value += 1
@@ -121,30 +643,38 @@ class Player(pg.sprite.Sprite):
     Playerのイニシャライザ
     動作メソッド、
     銃の発射位置メソッドを生成しているクラス
+    画像・マスク・速度・銃の位置は選択されたCharacterPackから受け取る。
     """
 
-    speed = 1
-    gun_offset = 0
-    images: List[pg.Surface] = []
-
-    def __init__(self, *groups):
+    def __init__(self, pack, *groups):
         pg.sprite.Sprite.__init__(self, *groups)
+        self.pack = pack
+        self.images = pack.images
+        self.masks = pack.masks
+        self.speed = pack.speed
+        self.gun_offset = pack.gun_offset
         self.image = self.images[0]
-        self.rect = self.image.get_rect(midbottom=SCREENRECT.midbottom)
+        self.mask = self.masks[0]
+        self.rect = self.image.get_rect(midbottom=ARENARECT.midbottom)
         self.reloading = 0
         self.origtop = self.rect.top
         self.facing = -1
-        self.gauge = Gauge((0, SCREENRECT.height - 100), *groups)  # プレイヤーのゲージ
+        self.gauge = Gauge((0, SCREENRECT.height - 100))  # プレイヤーのゲージ(画面に固定して表示する)
 
-    def move(self, direction):
+    def move(self, direction, bounds=ARENARECT):
+        """
+        左右に動かす。boundsの外には出ない(対戦中はカメラに映る範囲を渡す)
+        """
         if direction:
             self.facing = direction
         self.rect.move_ip(direction * self.speed, 0)
-        self.rect = self.rect.clamp(SCREENRECT)
+        self.rect = self.rect.clamp(bounds)
         if direction < 0:
             self.image = self.images[0]
+            self.mask = self.masks[0]
         elif direction > 0:
             self.image = self.images[1]
+            self.mask = self.masks[1]
 
     def gunpos(self):
         pos = self.facing * self.gun_offset + self.rect.centerx
@@ -156,53 +686,63 @@ class Alien(pg.sprite.Sprite):
     動作メソッド
     銃の発射位置メソッド
     エイリアンの位置更新メソッドを生成しているクラス
+    画像・マスク・速度・銃の位置は選択されたCharacterPackから受け取る。
     """
 
-    speed = 1
-    gun_offset = 0
-    images: List[pg.Surface] = []
-
-    def __init__(self, *groups):
+    def __init__(self, pack, *groups):
         pg.sprite.Sprite.__init__(self, *groups)
+        self.pack = pack
+        self.images = pack.images
+        self.masks = pack.masks
+        self.speed = pack.speed
+        self.gun_offset = pack.gun_offset
         self.image = self.images[0]
+        self.mask = self.masks[0]
         self.reloading = 0
-        self.rect = self.image.get_rect(midtop=SCREENRECT.midtop)
+        self.rect = self.image.get_rect(midtop=ARENARECT.midtop)
         self.facing = -1
         self.origbottom = self.rect.bottom
-        self.gauge = Gauge((0, 0), *groups)  # エイリアンのゲージ
+        self.gauge = Gauge((0, 0))  # エイリアンのゲージ(画面に固定して表示する)
         
-    def move(self, direction):
+    def move(self, direction, bounds=ARENARECT):
+        """
+        左右に動かす。boundsの外には出ない(対戦中はカメラに映る範囲を渡す)
+        """
         if direction:
             self.facing = direction
         self.rect.move_ip(direction * self.speed, 0)
-        self.rect = self.rect.clamp(SCREENRECT)
+        self.rect = self.rect.clamp(bounds)
         if direction < 0:
             self.image = self.images[0]
+            self.mask = self.masks[0]
         elif direction > 0:
             self.image = self.images[1]
+            self.mask = self.masks[1]
     
     def gunpos(self):
-        pos = self.rect.centerx
+        pos = self.facing * self.gun_offset + self.rect.centerx
         return pos, self.rect.bottom
 
     def update(self):
         #self.rect.move_ip(self.facing, 0)
-        if not SCREENRECT.contains(self.rect):
+        if not ARENARECT.contains(self.rect):
             self.facing = -self.facing
-            self.rect = self.rect.clamp(SCREENRECT)
+            self.rect = self.rect.clamp(ARENARECT)
             
 
-class Explosion(pg.sprite.Sprite):
+class Explosion(Entity):
     """
     オブジェクトが衝突した際に爆発する演出を作成するクラス
     """
 
+    __slots__ = ("life",)
     defaultlife = 12
     animcycle = 3
+    static = True  # 動かないので、SpatialGridで毎フレーム位置を調べ直さない
     images: List[pg.Surface] = []
 
     def __init__(self, actor, *groups):
-        pg.sprite.Sprite.__init__(self, *groups)
+        Entity.__init__(self, *groups)
         self.image = self.images[0]
         self.rect = self.image.get_rect(center=actor.rect.center)
         self.life = self.defaultlife
@@ -214,180 +754,754 @@ class Explosion(pg.sprite.Sprite):
         Show the explosion surface for 'defaultlife'.
         Every game tick(update), we decrease the 'life'.
 
-        Also we animate the explosion.
+        The animation itself is done in animate().
         """
         self.life = self.life - 1
-        self.image = self.images[self.life // self.animcycle % 2]
         if self.life <= 0:
             self.kill()
 
+    def animate(self):
+        """
+        画像を切り替えて爆発を点滅させる
+        カメラに映っているときだけPlaySceneから呼ばれる。
+        """
+        self.image = self.images[self.life // self.animcycle % 2]
+
 
-class Shot(pg.sprite.Sprite):
+class ParticleSystem:
     """
-    Playerが使う銃を生成するクラス
+    爆発の破片や火花をまとめて扱うパーティクルのクラス
+    各パーティクルはスプライトにせず、位置・速度・寿命などをarrayに並べて持つ。
+    生きているパーティクルは配列の先頭count個に詰めておき、消えたものは末尾と入れ替えて消す。
+    画像はbake()で拡大縮小・回転済みのものを作っておき、描画はSurface.blitsで1回にまとめる。
+    更新と描画にかかった時間がPARTICLE_TIME_BUDGETを超えたら出せる数(limit)を減らし、
+    余裕があれば品質で決まる上限(ceiling)まで少しずつ戻す。
     """
 
-    speed = -3
-    images: List[pg.Surface] = []
-
-    def __init__(self, pos, angle, *groups):
-        pg.sprite.Sprite.__init__(self, *groups)
-        self.image = self.images[0]
-        self.rect = self.image.get_rect(midbottom=pos)
-        self.mask = pg.mask.from_surface(self.image)  # マスクを作成して透明部分を除外
-        self.angle = angle
-        self.dx = 0
-        self.dy = 0
+    frames: List[pg.Surface] = []  # bake()で作る画像
+    kinds: Dict[str, tuple] = {}  # 種類 -> (framesの先頭位置, 回転の数, 大きさの数)
+    rotations = 8
+    debris_sizes = (24, 18, 12, 8, 4)
+    spark_sizes = (4, 3, 2, 1)
+    gravity = 0.15
+
+    def __init__(self, capacity=MAX_PARTICLES):
+        self.capacity = capacity
+        self.limit = capacity  # 現在出せる最大数
+        self.ceiling = capacity  # limitを戻してよい上限(品質を下げると小さくなる)
+        self.count = 0
+        self.x = array("f", bytes(4 * capacity))
+        self.y = array("f", bytes(4 * capacity))
+        self.vx = array("f", bytes(4 * capacity))
+        self.vy = array("f", bytes(4 * capacity))
+        self.life = array("H", bytes(2 * capacity))
+        self.maxlife = array("H", bytes(2 * capacity))
+        self.base = array("H", bytes(2 * capacity))  # 種類ごとのframesの先頭位置
+        self.rot = array("i", bytes(4 * capacity))
+        self.spin = array("b", bytes(capacity))
+        self.last_rects: List[pg.Rect] = []
+        self.elapsed_ms = 0.0  # 直前のupdate()とdraw()にかかった時間
+
+    @classmethod
+    def bake(cls, image):
+        """
+        爆発画像から破片の画像を、色から火花の画像を作ってframesに登録する
+        framesの並びは 種類ごとに [回転][大きさ] の順
+        """
+        frames = []
+        debris = image.copy()
+        debris.set_colorkey(image.get_colorkey())
+        cls.kinds["debris"] = (len(frames), cls.rotations, len(cls.debris_sizes))
+        for r in range(cls.rotations):
+            rotated = pg.transform.rotate(debris, r * 360 / cls.rotations)
+            for size in cls.debris_sizes:
+                frame = pg.transform.scale(rotated, (size, size))
+                frame.set_colorkey(image.get_colorkey())
+                frames.append(frame.convert())
+        cls.kinds["spark"] = (len(frames), 1, len(cls.spark_sizes))
+        for size in cls.spark_sizes:
+            frame = pg.Surface((size * 2, size * 2))
+            frame.set_colorkey((0, 0, 0))
+            pg.draw.circle(frame, (255, 230, 120), (size, size), size)
+            frames.append(frame.convert())
+        cls.frames = frames
+
+    def burst(self, pos, count, kind="debris", speed=6.0, life=30):
+        """
+        posを中心に四方へcount個のパーティクルを飛ばす
+        出せる数(limit)を超える分は出さない。
+        戻り値: int : 実際に出した数
+        """
+        count = max(0, min(count, self.limit - self.count))
+        base, rotations, _ = self.kinds[kind]
+        x, y = pos
+        for _ in range(count):
+            i = self.count
+            angle = random.uniform(0, math.tau)
+            v = random.uniform(0.2, 1.0) * speed
+            self.x[i] = x
+            self.y[i] = y
+            self.vx[i] = math.cos(angle) * v
+            self.vy[i] = math.sin(angle) * v
+            self.maxlife[i] = self.life[i] = random.randint(life // 2, life)
+            self.base[i] = base
+            self.rot[i] = random.randrange(rotations)
+            self.spin[i] = random.choice((-1, 1)) if rotations > 1 else 0
+            self.count += 1
+        return count
 
     def update(self):
         """
-        called every time around the game loop.
+        全パーティクルを1フレーム進め、寿命が尽きたものを消す
+        """
+        start = time.perf_counter()
+        x, y, vx, vy, life = self.x, self.y, self.vx, self.vy, self.life
+        gravity = self.gravity
+        i = 0
+        while i < self.count:
+            life[i] -= 1
+            if life[i] == 0:
+                self.remove(i)
+                continue
+            vy[i] += gravity
+            x[i] += vx[i]
+            y[i] += vy[i]
+            self.rot[i] += self.spin[i]
+            i += 1
+        self.elapsed_ms = (time.perf_counter() - start) * 1000
+
+    def remove(self, i):
+        """
+        i番目を末尾のパーティクルで上書きして消す
+        """
+        last = self.count - 1
+        for values in (self.x, self.y, self.vx, self.vy, self.life, self.maxlife, self.base, self.rot, self.spin):
+            values[i] = values[last]
+        self.count = last
 
-        Every tick we move the shot upwards.
+    def draw(self, screen, view=None):
         """
-        # self.dx = self.speed * math.sin(math.radians(self.angle))
-        self.dy = self.speed * math.cos(math.radians(self.angle))
-    
-        # self.rect.center = self.rect.centerx + dx, self.rect.centery + dy
-        self.rect.move_ip(self.dx, self.dy)
-        
-        if self.rect.top <= 0 or self.rect.left <= 0 or self.rect.right >= SCREENRECT.width or self.rect.bottom >= SCREENRECT.height:
-            self.kill()
-            
-    def spread_shot(pos, shots_group, all_sprites_group, spread=5, count=3):
-        start_angle = -spread * (count - 1) / 2
-        for i in range(count):
-            angle = start_angle + spread * i
-            print(angle)
-            # shot = Shot(pos, angle, shots_group, all_sprites_group)
-            # shots_group.add(shot)
-            # all_sprites_group.add(shot)
+        全パーティクルを1回のblitsで描き、前回と今回の描画範囲を返す
+        """
+        sequence = self.sequence(view)
+        start = time.perf_counter()
+        rects = screen.blits(sequence) if sequence else []
+        dirty = self.last_rects + rects
+        self.last_rects = rects
+        self.elapsed_ms += (time.perf_counter() - start) * 1000
+        self.adjust_limit()
+        return dirty
+
+    def sequence(self, view=None):
+        """
+        Surface.blitsに渡す(画像, 位置)のリストを作る
+        viewを渡すと、その範囲(対戦の場の座標)に入るものだけを画面の座標にして並べる。
+        """
+        start = time.perf_counter()
+        frames = self.frames
+        kinds = {base: (rotations, sizes) for base, rotations, sizes in self.kinds.values()}
+        if view is None:
+            view = pg.Rect(0, 0, *SCREENRECT.size)
+        margin = self.debris_sizes[0]  # 一番大きい画像の分だけ外側も含める
+        left, top = view.left, view.top
+        right, bottom = view.right, view.bottom
+        x, y = self.x, self.y
+        sequence = []
+        for i in range(self.count):
+            if not (left - margin < x[i] < right and top - margin < y[i] < bottom):
+                continue
+            base = self.base[i]
+            rotations, sizes = kinds[base]
+            size = sizes - 1 - (self.life[i] * sizes - 1) // self.maxlife[i]  # 寿命が減るほど小さくする
+            frame = frames[base + self.rot[i] % rotations * sizes + size]
+            sequence.append((frame, (x[i] - left, y[i] - top)))
+        self.elapsed_ms += (time.perf_counter() - start) * 1000
+        return sequence
+
+    def erase(self, screen, background):
+        """
+        前回描いたパーティクルを背景で消す
+        """
+        screen.blits([(background, rect, rect) for rect in self.last_rects], doreturn=False)
 
+    def adjust_limit(self):
+        """
+        かかった時間に応じて出せる数を増減する(増やすときはゆっくり)
+        """
+        if self.elapsed_ms > PARTICLE_TIME_BUDGET:
+            self.limit = max(PARTICLE_MIN_LIMIT, int(self.limit * 0.75))
+        elif self.elapsed_ms < PARTICLE_TIME_BUDGET / 2 and self.limit < self.ceiling:
+            self.limit = min(self.ceiling, self.limit + PARTICLE_MIN_LIMIT // 4)
+
+    def set_ceiling(self, ceiling):
+        """
+        出せる数の上限を変える。下げたときはlimitもすぐに下げる
+        """
+        self.ceiling = max(PARTICLE_MIN_LIMIT, min(self.capacity, ceiling))
+        self.limit = min(self.limit, self.ceiling)
+
+    def clear(self):
+        self.count = 0
+        self.last_rects = []
 
-class Speed_shot(Shot):
-    speed = -15
-    def __init__(self, pos, *groups):
-        super().__init__(pos, *groups)
-        
 
-class Bomb(pg.sprite.Sprite):
+class Starfield:
     """
-    Alienが落とす爆弾を生成するクラス
+    奥から手前へ流れる多重スクロールの背景クラス
+    ・一番奥の層(宇宙の画像)は上下に継ぎ目なくつながる縦長の帯として最初に一度だけ合成しておき、
+      BACKGROUND_SCROLL_INTERVALフレームごとに1ピクセルずつ下へ流す。
+      流すときは画面全体を描き直さず、Surface.scrollで画素をずらして新しく見える1行だけを帯から写す。
+    ・手前の星の層は少数の小さな画像を層ごとの速さで動かし、前回の位置だけを背景で消す。
+    負荷が高いときは、描く星の層の数(depth)を減らしたり奥の層を流すのを止めたり(scrolling)できる。
     """
 
-    speed = 3
-    images: List[pg.Surface] = []
-
-    def __init__(self, alien_pos, bomb_angle=0, *groups):
-        pg.sprite.Sprite.__init__(self, *groups)
-        self.image = self.images[0]
-        self.rect = self.image.get_rect(midtop=alien_pos)
-        self.bomb_angle = bomb_angle
-        self.dx = 0
-        self.dy = 0
-        
-    def update(self):
+    layers = (  # (1フレームに進むピクセル数, 星の数, 星の大きさ, 明るさ)
+        (1, 40, 1, 140),
+        (2, 20, 2, 200),
+        (4, 10, 2, 255),
+    )
+
+    def __init__(self, strip):
+        self.strip = strip  # make_strip()で作ってconvertした帯(Assets.star_strip)
+        self.offset = 0  # 画面の一番上に見えている帯の行
+        self.frame = 0
+        self.depth = len(self.layers)  # 描く星の層の数(奥から数える)
+        self.scrolling = True  # Falseなら奥の層を流さない
+        self.background = pg.Surface(SCREENRECT.size).convert()
+        self.background.blit(self.strip, (0, 0), pg.Rect(0, 0, *SCREENRECT.size))
+
+        self.images = []
+        for _, _, size, bright in self.layers:
+            star = pg.Surface((size, size * 3 if size > 1 else 1))  # 速い星は縦に伸ばして流れて見せる
+            star.fill((bright, bright, bright))
+            self.images.append(star.convert())
+        self.stars = [
+            [[random.randrange(SCREENRECT.width), random.randrange(SCREENRECT.height)] for _ in range(count)]
+            for _, count, _, _ in self.layers
+        ]
+        self.last_rects: List[pg.Rect] = []
+
+    @staticmethod
+    def make_strip(image):
         """
-        - make an explosion.
-        - remove the Bomb.
+        一番奥の層の帯を作って返す。convertはしないので別スレッドから呼んでよい
         """
-        # dx = self.speed * math.sin(math.radians(self.bomb_angle))
-        self.dy = self.speed * math.cos(math.radians(self.bomb_angle))
-        self.rect.move_ip(self.dx, self.dy)
-        if self.rect.top <= 0 or self.rect.left <= 0 or self.rect.right >= SCREENRECT.width or self.rect.bottom >= SCREENRECT.height:
-            self.kill()
-    
-    def spread_bomb(pos, bombs_group, all_sprites_group, spread=5, count=3):
-        start_angle = -spread * (count - 1) / 2
-        for i in range(count):
-            angle = start_angle + spread * i
-            bomb = Bomb(pos, angle)
-            bombs_group.add(bomb)
-            all_sprites_group.add(bomb)
+        width, height = SCREENRECT.width, min(image.get_height(), 1080)
+        height = max(height, SCREENRECT.height)
+        crop = pg.Surface((width, height))
+        crop.blit(image, (0, 0))
+        # 上下反転したものをつなげて、端と端が継ぎ目なくつながる帯にする
+        strip = pg.Surface((width, height * 2))
+        strip.blit(crop, (0, 0))
+        strip.blit(pg.transform.flip(crop, 0, 1), (0, height))
+        return strip
+
+    def clear(self, screen):
+        """
+        前回描いた星を背景で消す
+        """
+        background = self.background
+        screen.blits([(background, rect, rect) for rect in self.last_rects], doreturn=False)
 
+    def scroll(self, screen):
+        """
+        奥の層を進める。screenは星やスプライトを消し終えて背景だけの状態で渡す
+        戻り値: bool : 画面全体が動いたらTrue (画面全体の更新が必要)
+        """
+        self.frame += 1
+        if not self.scrolling or self.frame % BACKGROUND_SCROLL_INTERVAL:
+            return False
+        self.offset = (self.offset - 1) % self.strip.get_height()
+        row = pg.Rect(0, self.offset, SCREENRECT.width, 1)
+        for surface in (self.background, screen):
+            surface.scroll(0, 1)
+            surface.blit(self.strip, (0, 0), row)
+        return True
+
+    def draw(self, screen):
+        """
+        星を進めて描き、前回と今回の描画範囲を返す
+        """
+        height = SCREENRECT.height
+        sequence = []
+        for (speed, _, _, _), image, stars in zip(self.layers[:self.depth], self.images, self.stars):
+            for star in stars:
+                star[1] += speed
+                if star[1] >= height:
+                    star[0] = random.randrange(SCREENRECT.width)
+                    star[1] -= height
+                sequence.append((image, star))
+        rects = screen.blits(sequence)
+        dirty = self.last_rects + rects
+        self.last_rects = rects
+        return dirty
+
+    def pan(self, dx, dy):
+        """
+        カメラが(dx, dy)動いた分だけ星を逆向きにずらす
+        手前の層ほど大きくずらして奥行きを出す。一番奥の層は十分遠いものとして動かさない。
+        """
+        if not (dx or dy):
+            return
+        width, height = SCREENRECT.size
+        fastest = self.layers[-1][0]
+        for (speed, _, _, _), stars in zip(self.layers, self.stars):
+            rate = speed / fastest
+            for star in stars:
+                star[0] = (star[0] - dx * rate) % width
+                star[1] = (star[1] - dy * rate) % height
+
+    def redraw(self, screen):
+        """
+        画面全体を今の背景で描き直す(場面の切り替え時など)
+        """
+        screen.blit(self.background, (0, 0))
+        self.last_rects = []
 
-class Speed_bomb(Bomb):
-    speed = 15
-    def __init__(self, pos, *groups):
-        super().__init__(pos, *groups)
 
-        
-class PlayerScore(pg.sprite.Sprite):
+class Camera:
     """
-    状況に応じて増減し、playerのScoreに関与するスコアクラス
+    対戦の場(ARENARECT)のうち画面に映す範囲(view)を決めるクラス
+    追う対象たちの中心へ毎フレームCAMERA_FOLLOW_RATEの割合ずつ寄せ、場の外は映さない。
     """
 
-    def __init__(self, *groups):
-        pg.sprite.Sprite.__init__(self, *groups)
-        self.font = pg.font.Font(None, 20)
-        self.font.set_italic(16)
-        self.color ="white"
-        self.lastscore = -1
-        self.update()
-        self.rect = self.image.get_rect().move(500, 450)
-
-    def update(self):
-        """We only update the score in update() when it has changed."""
-        global PLAYER_SCORE
-        if PLAYER_SCORE != self.lastscore:
-            self.lastscore = PLAYER_SCORE
-            msg = f"Player Score: {PLAYER_SCORE}"
-            self.image = self.font.render(msg, 0, self.color)
+    def __init__(self):
+        self.arena = ARENARECT
+        self.view = pg.Rect((0, 0), SCREENRECT.size)
+        self.x = 0.0
+        self.y = 0.0
 
+    def target(self, sprites):
+        """
+        spritesをすべて囲む矩形の中心が画面の中央に来るときのviewの左上を、場の中に収めて返す
+        """
+        rects = [sprite.rect for sprite in sprites]
+        if not rects:
+            return self.x, self.y
+        cx, cy = rects[0].unionall(rects[1:]).center
+        x = min(max(cx - self.view.width / 2, self.arena.left), self.arena.right - self.view.width)
+        y = min(max(cy - self.view.height / 2, self.arena.top), self.arena.bottom - self.view.height)
+        return x, y
+
+    def reset(self, sprites):
+        """
+        spritesを映す位置へすぐに移す(対戦の開始時)
+        """
+        self.x, self.y = self.target(sprites)
+        self.view.topleft = round(self.x), round(self.y)
 
-class AlienScore(pg.sprite.Sprite):
-    """
-    状況に応じて増減し、AlienのScore関与するスコアクラス
-    """
+    def follow(self, sprites):
+        """
+        spritesを映す位置へ少しずつ寄せる
+        """
+        x, y = self.target(sprites)
+        self.x += (x - self.x) * CAMERA_FOLLOW_RATE
+        self.y += (y - self.y) * CAMERA_FOLLOW_RATE
+        self.view.topleft = round(self.x), round(self.y)
 
-    def __init__(self, *groups):
-        pg.sprite.Sprite.__init__(self, *groups)
-        self.font = pg.font.Font(None, 20)
-        self.font.set_italic(1)
-        self.color ="white"
-        self.lastscore = -1
-        self.update()
-        self.rect = self.image.get_rect().move(500, 20)
 
-    def update(self):
-        """We only update the score in update() when it has changed."""
-        global ALIEN_SCORE
-        if ALIEN_SCORE != self.lastscore:
-            self.lastscore = ALIEN_SCORE
-            msg = f"Alien Score: {ALIEN_SCORE}"
-            self.image = self.font.render(msg, 0, self.color)
-            
-            
-class Item(pg.sprite.Sprite):
+class SpatialGrid:
     """
-    ゲーム内でアイテムを表現するクラス。
-    speed : int : アイテムの移動速度。
-    images : List[pg.Surface] : アイテムを表現する画像のリスト。
-    rect : pg.Rect : アイテムの位置とサイズを表す矩形。
-    spawned : bool : アイテムが生成されたかどうかを示すフラグ。
-    メソッド:
-    update():アイテムの位置を更新し、画面端との衝突を処理する。
-    spawn():アイテムを画面の中央に生成する。
-    is_spawned() -> bool:アイテムが現在生成されているかどうかを確認する。
-    collide_bombs(bombs: pg.sprite.Group) -> bool:爆弾との衝突を確認し、処理する。
-    collide_shots(shots: pg.sprite.Group) -> bool:ショットとの衝突を確認し、処理する。
-    reset():アイテムを初期状態にリセットする。
+    スプライトを、矩形の中心があるマス(CULL_CELL_SIZE四方)ごとに登録しておく格子
+    query()は範囲に重なるマスだけを調べるので、カメラに映るスプライトを探す手間は
+    場の広さやスプライトの総数ではなく、映っている範囲の混み具合で決まる。
+    出し入れはArenaGroupから知らされ、毎フレームのrefresh()では新しく入ったものを置き、
+    動くスプライトのうちマスが変わったものだけを移す(static = Trueのスプライトは調べない)。
     """
-    
-    images: List[pg.Surface] = []#itemの画像リスト
 
-    def __init__(self, *groups: pg.sprite.AbstractGroup) -> None:
+    def __init__(self, cell=CULL_CELL_SIZE):
+        self.cell = cell
+        self.cells: Dict[tuple, Dict[pg.sprite.Sprite, int]] = {}  # マス -> {スプライト: 登録順}
+        self.keys: Dict[pg.sprite.Sprite, tuple] = {}  # スプライト -> マス
+        self.moving: Dict[pg.sprite.Sprite, None] = {}  # 動くスプライト
+        self.pending: Dict[pg.sprite.Sprite, int] = {}  # まだマスに置いていないスプライト -> 登録順
+        self.count = 0  # これまでに登録した数(描く順を元のグループと同じにするのに使う)
+        self.margin = 0  # 登録したスプライトの幅と高さの最大値の半分
+
+    def insert(self, sprite):
         """
-        Itemオブジェクトを初期化する。
-        引数: *groups : pg.sprite.AbstractGroup : スプライトが所属するグループ。
+        スプライトを登録する。グループに入る時点ではrectがまだ無いので、マスに置くのは次のrefresh()
         """
-        pg.sprite.Sprite.__init__(self, *groups)
-        self.image = pg.transform.scale(self.images[0], (64, 48))  # 画像サイズを変更
-        self.image.set_colorkey((255, 255, 255))  # 背景を透明に設定
-        self.rect = self.image.get_rect(center=SCREENRECT.center)  # 矩形を取得
-        self.mask = pg.mask.from_surface(self.image)  # マスクを作成して透明部分を除外
-        self.rect.topleft = (-100, -100)  # 初期位置を画面外に設定
-        self.speed = random.uniform(1.0, 3.0)
+        self.pending[sprite] = self.count
+        self.count += 1
+
+    def remove(self, sprite):
+        if self.pending.pop(sprite, None) is not None:
+            return
+        key = self.keys.pop(sprite, None)
+        if key is None:
+            return
+        bucket = self.cells[key]
+        del bucket[sprite]
+        if not bucket:
+            del self.cells[key]
+        self.moving.pop(sprite, None)
+
+    def refresh(self):
+        """
+        新しく登録されたスプライトをマスに置き、動くスプライトのうちマスが変わったものを移し替える
+        """
+        cell = self.cell
+        cells, keys = self.cells, self.keys
+        for sprite, order in self.pending.items():
+            rect = sprite.rect
+            x, y = rect.center
+            key = (x // cell, y // cell)
+            cells.setdefault(key, {})[sprite] = order
+            keys[sprite] = key
+            if not getattr(sprite, "static", False):
+                self.moving[sprite] = None
+            self.margin = max(self.margin, (max(rect.size) + 1) // 2)
+        self.pending.clear()
+        for sprite in self.moving:
+            x, y = sprite.rect.center
+            key = (x // cell, y // cell)
+            old = keys[sprite]
+            if key != old:
+                bucket = cells[old]
+                order = bucket.pop(sprite)
+                if not bucket:
+                    del cells[old]
+                cells.setdefault(key, {})[sprite] = order
+                keys[sprite] = key
+
+    def query(self, rect):
+        """
+        rectに重なるスプライトを登録した順に並べて返す
+        中心がrectの外にあってもはみ出して映るものがあるので、marginだけ広いマスまで調べる。
+        """
+        cell = self.cell
+        cells = self.cells
+        area = rect.inflate(self.margin * 2, self.margin * 2)
+        found = []
+        for cx in range(area.left // cell, (area.right - 1) // cell + 1):
+            for cy in range(area.top // cell, (area.bottom - 1) // cell + 1):
+                bucket = cells.get((cx, cy))
+                if bucket:
+                    found += [(order, sprite) for sprite, order in bucket.items() if rect.colliderect(sprite.rect)]
+        found.sort(key=lambda entry: entry[0])
+        return [sprite for _, sprite in found]
+
+
+class ArenaGroup(pg.sprite.Group):
+    """
+    対戦の場のスプライトを入れるグループ
+    出し入れ(add, kill, emptyなど)に合わせてSpatialGridにも登録・削除する。
+    """
+
+    def __init__(self, grid, *sprites):
+        self.grid = grid
+        super().__init__(*sprites)
+
+    def add_internal(self, sprite, layer=None):
+        super().add_internal(sprite, layer)
+        self.grid.insert(sprite)
+
+    def remove_internal(self, sprite):
+        super().remove_internal(sprite)
+        self.grid.remove(sprite)
+
+
+class BulletPattern:
+    """
+    弾の撃ち方(1回に撃つ弾の数・向き・速さ)の定義から、弾の軌道を前もって計算しておくクラス
+    定義(dict)の書式:
+        shape : str : "fan"(正面を中心に扇形) "ring"(全周に等間隔) "spiral"(撃つたびにturnだけ回る扇形)
+                      "aimed"(相手の方を中心に扇形)
+        count : int : 1回に撃つ弾の数
+        spread : float : 扇形で隣り合う弾の間の角度(度)。ringでは360/countになる
+        turn : float : spiralで1回撃つごとに回る角度(度)
+        speed : float : 1ティックに進むピクセル数
+        accel : float : 1ティックごとに速さに足す値(省略時0)。速くなるならmax_speed、遅くなるならmin_speed(省略時0)で止める
+        curve : float : 1ティックごとに進む向きが曲がる角度(度、省略時0)
+    角度は正面(Playerの弾なら上、Alienの爆弾なら下)を0として、右回りを正とする。
+    弾の軌道は向きごとに1度だけ計算して表(発射位置からのずれ)にしてpathsに置いておき、
+    弾は毎ティック表を1つ進めるだけにして三角関数を使わない。
+    表はキャラクターパックを読み込むときにprecompile()で撃つことのある向きの分をすべて作っておき、
+    対戦中に計算しない。上向きの表は下向きの表の縦のずれを反転して作る。
+    表はパターンごとに持ち、パターンを使うキャラクターパックがCharacterCatalogから追い出されるとまとめて解放される。
+    """
+
+    SHAPES = ("fan", "ring", "spiral", "aimed")
+    compiled: "weakref.WeakValueDictionary[str, BulletPattern]" = weakref.WeakValueDictionary()  # 定義のjson -> BulletPattern
+
+    def __init__(self, definition):
+        self.shape = definition.get("shape", "fan")
+        if self.shape not in self.SHAPES:
+            raise ValueError(f"unknown bullet pattern shape: {self.shape}")
+        self.count = definition.get("count", 1)
+        if self.shape == "ring":
+            self.spread = 360 / self.count
+        else:
+            self.spread = definition.get("spread", 0)
+        self.turn = definition.get("turn", 0)
+        accel = definition.get("accel", 0)
+        if accel >= 0:
+            limit = definition.get("max_speed", math.inf)
+        else:
+            limit = definition.get("min_speed", 0)
+        self.motion = (definition.get("speed", 3), accel, limit, definition.get("curve", 0))
+        first = -self.spread * (self.count - 1) / 2
+        self.offsets = [first + self.spread * i for i in range(self.count)]  # 中心の向きからの各弾の角度
+        self.paths: Dict[tuple, array] = {}  # (向き, 前向き) -> 軌道表
+
+    @classmethod
+    def get(cls, definition):
+        """
+        定義に対応するBulletPatternを返す。同じ定義は使われている間は1つを共有する
+        """
+        key = json.dumps(definition, sort_keys=True)
+        pattern = cls.compiled.get(key)
+        if pattern is None:
+            pattern = cls.compiled[key] = cls(definition)
+        return pattern
+
+    @staticmethod
+    def quantize(angle):
+        """
+        軌道表を共有するため、向きをPATTERN_ANGLE_STEPの刻みにそろえて0以上360未満にする
+        """
+        return round(angle / PATTERN_ANGLE_STEP) * PATTERN_ANGLE_STEP % 360
+
+    def headings(self):
+        """
+        このパターンで撃つことのある向き(quantize済み)の集合を返す
+        """
+        centers = [0]
+        if self.shape == "spiral" and self.turn:
+            # 撃つたびに回る向きが一周して元に戻るまで(刻みにそろえた上で)
+            for volley in range(1, int(3600 / PATTERN_ANGLE_STEP)):
+                center = self.quantize(self.turn * volley)
+                if center == 0:
+                    break
+                centers.append(center)
+        elif self.shape == "aimed":
+            steps = int(PATTERN_AIM_LIMIT / PATTERN_ANGLE_STEP)
+            centers = [step * PATTERN_ANGLE_STEP for step in range(-steps, steps + 1)]
+        return {self.quantize(center + offset) for center in centers for offset in self.offsets}
+
+    def precompile(self):
+        """
+        撃つことのある向きの軌道表を上向き・下向きともすべて作っておく
+        """
+        for angle in self.headings():
+            for direction in (1, -1):
+                self.path(angle, direction)
+
+    def path(self, angle, direction):
+        """
+        angleの向きに撃った弾の軌道表を返す
+        表は[x1, y1, x2, y2, ...]の形で、各ティックの発射位置からのずれ(ピクセル)を並べたもの。
+        対戦の場の対角線より遠くへ進んだところで終わる。
+        """
+        angle = self.quantize(angle)
+        key = (angle, direction)
+        path = self.paths.get(key)
+        if path is not None:
+            return path
+        if direction != 1:
+            path = array("h", self.path(angle, 1))
+            path[1::2] = array("h", map(neg, path[1::2]))
+            self.paths[key] = path
+            return path
+        speed, accel, limit, curve = self.motion
+        reach = math.hypot(*ARENARECT.size) ** 2
+        path = array("h")
+        x = y = 0.0
+        heading = angle
+        sin, cos = math.sin(math.radians(heading)), math.cos(math.radians(heading))
+        for _ in range(PATTERN_MAX_TICKS):
+            x += speed * sin
+            y += speed * cos
+            path.append(round(x))
+            path.append(round(y))
+            if x * x + y * y > reach:
+                break
+            if accel:
+                speed = min(speed + accel, limit) if accel > 0 else max(speed + accel, limit)
+            if curve:
+                heading += curve
+                sin, cos = math.sin(math.radians(heading)), math.cos(math.radians(heading))
+        self.paths[key] = path
+        return path
+
+    def angles(self, pos, direction, volley=0, target=None):
+        """
+        volley回目に撃つ各弾の向き(度)のリストを返す
+        """
+        center = 0
+        if self.shape == "spiral":
+            center = self.turn * volley
+        elif self.shape == "aimed" and target is not None:
+            center = math.degrees(math.atan2(target[0] - pos[0], (target[1] - pos[1]) * direction))
+            center = max(-PATTERN_AIM_LIMIT, min(PATTERN_AIM_LIMIT, center))
+        return [center + offset for offset in self.offsets]
+
+    def fire(self, cls, pos, groups, volley=0, target=None):
+        """
+        cls(ShotかBomb)の弾を1回分まとめて作り、groupsに入れる
+        戻り値: 各弾の向き(度)のリスト
+        """
+        angles = self.angles(pos, cls.direction, volley, target)
+        for angle in angles:
+            cls(pos, self.path(angle, cls.direction), *groups)
+        return angles
+
+
+class Projectile(Entity):
+    """
+    BulletPatternの軌道表に沿って進む弾の基底クラス
+    発射位置と軌道表だけを持ち、毎ティック表を1つ進めて位置を決める。
+    表が終わるか対戦の場から出たら消える。
+    """
+
+    __slots__ = ("x0", "y0", "path", "step")
+    direction = 1  # 正面の向き(下が1、上が-1)
+
+    def __init__(self, pos, path, *groups):
+        Entity.__init__(self, *groups)
+        self.image = self.images[0]
+        self.rect = self.place(pos)
+        self.x0, self.y0 = self.rect.topleft
+        self.path = path
+        self.step = -2
+
+    def place(self, pos):
+        return self.image.get_rect(center=pos)
+
+    def update(self):
+        step = self.step = self.step + 2
+        try:
+            self.rect.topleft = (self.x0 + self.path[step], self.y0 + self.path[step + 1])
+        except IndexError:  # 軌道表の終わり
+            self.kill()
+            return
+        if not ARENARECT.contains(self.rect):
+            self.kill()
+
+
+class Shot(Projectile):
+    """
+    Playerが使う銃を生成するクラス
+    """
+
+    __slots__ = ()
+    direction = -1
+    images: List[pg.Surface] = []
+    mask: pg.mask.Mask = None  # 透明部分を除いたマスク(Assetsで作り、全ての弾で共有する)
+
+    def place(self, pos):
+        return self.image.get_rect(midbottom=pos)
+
+
+class Speed_shot(Shot):
+    __slots__ = ()
+
+
+class Bomb(Projectile):
+    """
+    Alienが落とす爆弾を生成するクラス
+    """
+
+    __slots__ = ()
+    direction = 1
+    images: List[pg.Surface] = []
+    mask: pg.mask.Mask = None  # アイテムとの当たり判定に使うマスク(Assetsで作り、全ての爆弾で共有する)
+
+    def place(self, pos):
+        return self.image.get_rect(midtop=pos)
+
+
+class Speed_bomb(Bomb):
+    __slots__ = ()
+
+        
+class PlayerScore(pg.sprite.Sprite):
+    """
+    状況に応じて増減し、playerのScoreに関与するスコアクラス
+    """
+
+    def __init__(self, *groups):
+        pg.sprite.Sprite.__init__(self, *groups)
+        self.font = get_font(20, italic=True)
+        self.color ="white"
+        self.lastscore = -1
+        self.update()
+        self.rect = self.image.get_rect().move(500, 450)
+
+    def update(self):
+        """We only update the score in update() when it has changed."""
+        global PLAYER_SCORE
+        if PLAYER_SCORE != self.lastscore:
+            self.lastscore = PLAYER_SCORE
+            msg = f"Player Score: {PLAYER_SCORE}"
+            self.image = self.font.render(msg, 0, self.color)
+
+
+class AlienScore(pg.sprite.Sprite):
+    """
+    状況に応じて増減し、AlienのScore関与するスコアクラス
+    """
+
+    def __init__(self, *groups):
+        pg.sprite.Sprite.__init__(self, *groups)
+        self.font = get_font(20, italic=True)
+        self.color ="white"
+        self.lastscore = -1
+        self.update()
+        self.rect = self.image.get_rect().move(500, 20)
+
+    def update(self):
+        """We only update the score in update() when it has changed."""
+        global ALIEN_SCORE
+        if ALIEN_SCORE != self.lastscore:
+            self.lastscore = ALIEN_SCORE
+            msg = f"Alien Score: {ALIEN_SCORE}"
+            self.image = self.font.render(msg, 0, self.color)
+            
+            
+class Item(Entity):
+    """
+    ゲーム内でアイテムを表現するクラス。
+    speed : int : アイテムの移動速度。
+    images : List[pg.Surface] : アイテムを表現する画像のリスト。
+    rect : pg.Rect : アイテムの位置とサイズを表す矩形。
+    spawned : bool : アイテムが生成されたかどうかを示すフラグ。
+    メソッド:
+    update():アイテムの位置を更新し、画面端との衝突を処理する。
+    spawn():アイテムを画面の中央に生成する。
+    is_spawned() -> bool:アイテムが現在生成されているかどうかを確認する。
+    collide_bombs(bombs: pg.sprite.Group) -> bool:爆弾との衝突を確認し、処理する。
+    collide_shots(shots: pg.sprite.Group) -> bool:ショットとの衝突を確認し、処理する。
+    reset():アイテムを初期状態にリセットする。
+    画像とマスクはprepare()で一度だけ作り、全てのアイテムで共有する。
+    """
+    
+    __slots__ = ("speed", "spawned")
+    images: List[pg.Surface] = []#itemの画像リスト
+    mask: pg.mask.Mask = None
+
+    @classmethod
+    def prepare(cls, image: pg.Surface) -> None:
+        """
+        アイテムの画像を表示する大きさにして、透明色とマスクを設定する。
+        引数: image : pg.Surface : 読み込んだアイテムの画像。
+        """
+        image = pg.transform.scale(image, (64, 48))  # 画像サイズを変更
+        image.set_colorkey((255, 255, 255))  # 背景を透明に設定
+        cls.images = [image]
+        cls.mask = pg.mask.from_surface(image)  # マスクを作成して透明部分を除外
+
+    def __init__(self, *groups: pg.sprite.AbstractGroup) -> None:
+        """
+        Itemオブジェクトを初期化する。
+        引数: *groups : pg.sprite.AbstractGroup : スプライトが所属するグループ。
+        """
+        Entity.__init__(self, *groups)
+        self.image = self.images[0]
+        self.rect = self.image.get_rect(center=ARENARECT.center)  # 矩形を取得
+        self.rect.topleft = (-100, -100)  # 初期位置を画面外に設定
+        self.speed = random.uniform(1.0, 3.0)
         self.spawned = False  # アイテムが生成されたかどうかのフラグ
 
     def update(self) -> None:
@@ -396,26 +1510,26 @@ class Item(pg.sprite.Sprite):
         """
         if self.spawned:
             self.rect.move_ip(self.speed, 0)  # アイテムを移動
-            if self.rect.right > SCREENRECT.right:
-                self.rect.right = SCREENRECT.right  # 右端に合わせる
+            if self.rect.right > ARENARECT.right:
+                self.rect.right = ARENARECT.right  # 右端に合わせる
                 self.speed = -self.speed  # 移動方向を反転
             if self.rect.left < 0:
                 self.rect.left = 0  # 左端に合わせる
                 self.speed = -self.speed  # 移動方向を反転
-            if self.rect.top > SCREENRECT.height:
+            if self.rect.top > ARENARECT.height:
                 self.kill()  # 画面外に出たらアイテムを消す
                 self.spawned = False  # フラグをリセット
                 
     def spawn(self) -> None:
         """
-        アイテムを画面の左右にランダムで生成する。
+        アイテムを対戦の場の左右の端にランダムで生成する。
         """
         side = random.choice(['left', 'right'])
         if side == 'left':
             self.rect.topleft = (0, random.randint(200, 280))
             self.speed = abs(self.speed) #右に方向転換
         else:
-            self.rect.topright = (SCREENRECT.width, random.randint(200, 280))
+            self.rect.topright = (ARENARECT.width, random.randint(200, 280))
             self.speed = -abs(self.speed) #左に方向転換
         self.spawned = True
 
@@ -438,7 +1552,6 @@ class Item(pg.sprite.Sprite):
             if collided:
                 self.kill()  # 衝突したらアイテムを消す
                 ALIEN_SCORE += 1
-                Alien.speed += 0.3
                 self.spawned = False  # フラグをリセット
                 self.rect.topleft = (-100, -100)  # 初期位置にリセット
                 return True
@@ -456,7 +1569,6 @@ class Item(pg.sprite.Sprite):
             if collided:
                 self.kill()
                 PLAYER_SCORE += 1
-                Player.speed += 0.3
                 self.spawned = False  # 衝突したらフラグをリセット
                 self.rect.topleft = (-100, -100)  # 画面外の初期位置にリセット
                 return True
@@ -474,263 +1586,2106 @@ class Win(pg.sprite.Sprite):
     """
     ・プレイヤーがエイリアンに爆弾を当てた際に画像と文字を呼び出す。
     ・エイリアンがプレイヤーに爆弾を当てた際に画像と文字を呼び出す。
+    勝者ごとの画面は一度だけ合成してsurfacesにキャッシュし、再戦時は使い回す。
     """
+
+    images: Dict[str, pg.Surface] = {}  # 勝者名 -> 勝利画像
+    surfaces: Dict[str, pg.Surface] = {}  # 勝者名 -> 合成済みの勝利画面
+
     def __init__(self, winner, *groups):
         pg.sprite.Sprite.__init__(self, *groups)
-        self.image = pg.Surface(SCREENRECT.size)
-        self.image.fill("black")
-        
-        if winner == "Player":
-            win_image = load_image("player_win.png")
-        else:
-            win_image = load_image("alien_win.png")
-        
+        if winner not in self.surfaces:
+            self.surfaces[winner] = self.render(winner)
+        self.image = self.surfaces[winner]
+        self.rect = self.image.get_rect()
+
+    @classmethod
+    def render(cls, winner):
+        """
+        勝利画面(黒背景 + 勝利画像 + 文字)を合成して返す
+        """
+        image = pg.Surface(SCREENRECT.size)
+        image.fill("black")
+
         # Resize the image to be smaller
-        win_image = pg.transform.scale(win_image, (SCREENRECT.width / 2, SCREENRECT.height / 2))
-        
+        win_image = pg.transform.scale(cls.images[winner], (SCREENRECT.width / 2, SCREENRECT.height / 2))
+
         # Blit the win image onto the black background
         win_image_rect = win_image.get_rect(center=(SCREENRECT.centerx, SCREENRECT.centery - 50))
-        self.image.blit(win_image, win_image_rect)
-        
+        image.blit(win_image, win_image_rect)
+
         # Render the win text
-        self.font = pg.font.Font(None, 80)
-        self.color = "white"
-        win_text = f"{winner} Wins!"
-        text_surface = self.font.render(win_text, True, self.color)
-        text_rect = text_surface.get_rect(center=(SCREENRECT.centerx, SCREENRECT.centery + 100))
-        self.image.blit(text_surface, text_rect)
-        
-        self.rect = self.image.get_rect()
-def main(winstyle=0):
-    # Initialize pygame
-    if pg.get_sdl_version()[0] == 2:
-        pg.mixer.pre_init(44100, 32, 2, 1024)
-    pg.init()
-    if pg.mixer and not pg.mixer.get_init():
-        print("Warning, no sound")
-        pg.mixer = None
+        if pg.font:
+            font = get_font(80)
+            text_surface = font.render(f"{winner} Wins!", True, "white")
+            text_rect = text_surface.get_rect(center=(SCREENRECT.centerx, SCREENRECT.centery + 100))
+            image.blit(text_surface, text_rect)
+        return image.convert()
 
-    fullscreen = False
-    winstyle = 0  # |FULLSCREEN
-    bestdepth = pg.display.mode_ok(SCREENRECT.size, winstyle, 32)
-    screen = pg.display.set_mode(SCREENRECT.size, winstyle, bestdepth)
-
-    # Load images, assign to sprite classes
-    img = load_image("3.png")
-    img.set_colorkey(0, 0)
-    Player.images = [img, pg.transform.flip(img, 1, 0)]
-    img = load_image("explosion1.gif")
-    Explosion.images = [img, pg.transform.flip(img, 1, 1)]
-    Alien.images = [load_image(im) for im in ("alien1.gif", "alien2.gif", "alien3.gif")]
-    Bomb.images = [load_image("bomb.gif")]
-    Shot.images = [load_image("shot.gif")]
-    Item.images = [load_image("item.png")]  # アイテム画像を読み込む
-
-    icon = pg.transform.scale(Player.images[0], (22, 32))
-    pg.display.set_icon(icon)
-    pg.display.set_caption("こうかとんスターシュート")
-    pg.mouse.set_visible(0)
 
-    bgdtile = load_image("utyuu.jpg")
-    background = pg.Surface(SCREENRECT.size)
-    background.blit(bgdtile, (0, 0))
-    screen.blit(background, (0, 0))
-    pg.display.flip()
-    
-    #ゲーム内効果音
-    boom_sound = load_sound("enemy-attack.wav")
-    shoot_sound = load_sound("fire-sword.wav")
-    explosion_sound = load_sound("Explosion.wav")
-    item_sound = load_sound("power_up.mp3")
-    beem_sound = load_sound("beem.sound.mp3")
-    bomb_special = load_sound("bomb_special.mp3")
-    
-    if pg.mixer:
-        music = os.path.join(main_dir, "data", "game_music.mp3")
-        pg.mixer.music.load(music)
-        pg.mixer.music.play(-1)
-
-    shots = pg.sprite.Group()
-    bombs = pg.sprite.Group()
-    items = pg.sprite.Group()
-    all = pg.sprite.RenderUpdates()
-
-    global PLAYER_SCORE, ALIEN_SCORE
-    player = Player(all)
-    alien = Alien(all)
-    
-    all.add(player.gauge)  # プレイヤーのゲージを追加
-    all.add(alien.gauge)  # エイリアンのゲージを追加
+class SoundManager:
+    """
+    効果音の再生を管理するクラス
+    ・効果音(pg.mixer.Sound)は読み込み時にPCMへデコード済みなので、再生時にデコードは起きない
+    ・SOUND_CHANNELS本のチャンネルを予約して使い回し、空きが無ければ優先度の低い古い音を止めて鳴らす
+    ・同じ効果音は1フレームに1回まで(SOUND_MIN_INTERVALミリ秒以内の連続再生もまとめる)
+    ・ミキサーの遅延と、鳴らせなかった回数などをstatsに記録する
+    mixerが無い環境では何もしない。
+    """
 
-    item = Item(items, all)  # アイテムを初期化し追加
+    def __init__(self, channels=SOUND_CHANNELS):
+        self.enabled = bool(pg.mixer and pg.mixer.get_init())
+        self.pool: List[pg.mixer.Channel] = []
+        self.playing: Dict[int, tuple] = {}  # チャンネル番号 -> (優先度, 開始時刻)
+        self.last_played: Dict[int, int] = {}  # 効果音のid -> 最後に鳴らした時刻
+        self.tick_played = set()  # このフレームで鳴らした効果音のid
+        self.stats = {"played": 0, "stolen": 0, "dropped": 0, "limited": 0, "max_play_ms": 0.0}
+        self.latency_ms = 0.0
+        self.voices = channels  # 使ってよいチャンネルの数(品質を下げると減る)
+        if self.enabled:
+            pg.mixer.set_num_channels(channels)
+            pg.mixer.set_reserved(channels)  # 自動割り当てに使わせず、このクラスだけが使う
+            self.pool = [pg.mixer.Channel(i) for i in range(channels)]
+            frequency = pg.mixer.get_init()[0]
+            self.latency_ms = MIXER_BUFFER / frequency * 1000
+
+    def tick(self):
+        """
+        フレームの始めに呼び、1フレームに1回までの制限をリセットする
+        """
+        self.tick_played.clear()
 
-    if pg.font:
-        all.add(PlayerScore(all))
-        all.add(AlienScore(all))
-    
-    item_timer = pg.time.get_ticks()
-    clock = pg.time.Clock()
-
-    while player.alive() and alien.alive():
-        background.blit(bgdtile, (0, 0))
-        screen.blit(background, (0, 0))
-        for event in pg.event.get():
-            if event.type == pg.QUIT:
+    def find_channel(self, priority):
+        """
+        空いているチャンネル、無ければ優先度がpriority以下で最も古い音のチャンネルを返す
+        """
+        victim = None
+        for index, channel in enumerate(self.pool[:self.voices]):
+            if not channel.get_busy():
+                return channel
+            playing = self.playing.get(index, (0, 0))
+            if playing[0] <= priority and (victim is None or playing < self.playing.get(victim, (0, 0))):
+                victim = index
+        if victim is None:
+            return None
+        self.stats["stolen"] += 1
+        return self.pool[victim]
+
+    def play(self, sound, priority=SOUND_PRIORITY_SHOT):
+        """
+        効果音を鳴らす。鳴らせなかったらFalseを返す
+        """
+        if not self.enabled or sound is None:
+            return False
+        start = time.perf_counter()
+        key = id(sound)
+        now = get_ticks()
+        if key in self.tick_played or now - self.last_played.get(key, -SOUND_MIN_INTERVAL) < SOUND_MIN_INTERVAL:
+            self.stats["limited"] += 1
+            return False
+        channel = self.find_channel(priority)
+        if channel is None:
+            self.stats["dropped"] += 1
+            return False
+        channel.play(sound)
+        self.playing[self.pool.index(channel)] = (priority, now)
+        self.tick_played.add(key)
+        self.last_played[key] = now
+        self.stats["played"] += 1
+        elapsed = (time.perf_counter() - start) * 1000
+        self.stats["max_play_ms"] = max(self.stats["max_play_ms"], elapsed)
+        return True
+
+    def pause(self):
+        if self.enabled:
+            pg.mixer.pause()
+            pg.mixer.music.pause()
+
+    def resume(self):
+        if self.enabled:
+            pg.mixer.unpause()
+            pg.mixer.music.unpause()
+
+    def play_music(self):
+        if self.enabled:
+            pg.mixer.music.play(-1)
+
+    def stop_music(self, fade=MUSIC_FADE_TIME):
+        """
+        BGMを止める。stop()ではなくfadeoutにして、呼び出し元を待たせない
+        """
+        if self.enabled:
+            pg.mixer.music.fadeout(fade)
+
+    def report(self):
+        stats = self.stats
+        return (
+            f"sound: latency {self.latency_ms:.1f} ms, played {stats['played']}, stolen {stats['stolen']}, "
+            f"dropped {stats['dropped']}, rate limited {stats['limited']}, max play {stats['max_play_ms']:.3f} ms"
+        )
+
+
+class CharacterPack:
+    """
+    キャラクター1体分の素材と性能をまとめたクラス
+    characters/<key>.json の内容から画像(左右向き)・マスク・効果音・速度・銃の位置を読み込む。
+    jsonの書式:
+        name : str : 選択画面に表示する名前
+        images : List[str] : main_dirからの画像パス。1枚目が左向き、2枚目が右向き
+        flip : bool : trueなら1枚目を左右反転したものを右向きに使う
+        colorkey : List[int] : 透明色 (省略可)
+        thumbnail : str : 選択画面のサムネイル (省略時はimagesの1枚目)
+        sounds : Dict[str, str] : "shot"(通常弾・spread_shot)と"speed"(speed_shot)の効果音
+        speed : float : 移動速度
+        gun_offset : int : 向いている方向への銃の位置のずれ
+        patterns : Dict[str, dict] : "normal" "spread" "speed"の弾の撃ち方 (省略した種類はPATTERNSのもの)
+    """
+
+    def __init__(self, key, info):
+        self.key = key
+        self.name = info.get("name", key)
+        images = []
+        for file in info["images"]:
+            img = load_image(file, "")
+            if info.get("colorkey") is not None:
+                img.set_colorkey(info["colorkey"], pg.RLEACCEL)
+            images.append(img)
+        if info.get("flip"):
+            images = [images[0], pg.transform.flip(images[0], 1, 0)]
+        elif len(images) == 1:
+            images.append(images[0])
+        self.images = images
+        self.masks = [pg.mask.from_surface(img) for img in images]
+        self.sounds = {kind: load_sound(file, "") for kind, file in info.get("sounds", {}).items()}
+        self.speed = info.get("speed", 1)
+        self.gun_offset = info.get("gun_offset", 0)
+        patterns = info.get("patterns", {})
+        self.patterns = {kind: BulletPattern.get(patterns.get(kind, definition)) for kind, definition in PATTERNS.items()}
+        for pattern in self.patterns.values():
+            pattern.precompile()  # 対戦中に軌道を計算しないよう、どちらの側で使われてもよい分を作っておく
+
+
+class CharacterCatalog:
+    """
+    characters/ 以下のキャラクター一覧を管理するクラス
+    起動時には小さなjsonだけを読み、サムネイルは別スレッドで順次デコードする。
+    CharacterPackは必要になったときに読み込み、最大CHARACTER_CACHE_SIZE個までLRUで保持する。
+    """
+
+    def __init__(self, folder=CHARACTER_DIR, cache_size=CHARACTER_CACHE_SIZE):
+        self.infos: Dict[str, dict] = {}
+        for name in list_assets(folder):
+            if name.endswith(".json"):
+                with open_asset(name) as f:
+                    self.infos[name.rpartition("/")[2][:-5]] = json.load(f)
+        if not self.infos:
+            raise SystemExit(f'No character packs found in "{folder}/"')
+        self.keys = list(self.infos)
+        self.cache_size = cache_size
+        self.cache: "OrderedDict[str, CharacterPack]" = OrderedDict()
+        self.thumbnails: Dict[str, pg.Surface] = {}
+        self.decoded: "queue.Queue" = queue.Queue()
+        self.loader = None
+
+    def start_thumbnails(self):
+        """
+        サムネイル画像のデコードを別スレッドで始める
+        """
+        if self.loader is None:
+            self.loader = threading.Thread(target=self._load_thumbnails, daemon=True)
+            self.loader.start()
+
+    def _load_thumbnails(self):
+        for key in self.keys:
+            info = self.infos[key]
+            file = info.get("thumbnail", info["images"][0])
+            try:
+                self.decoded.put((key, pg.image.load(find_asset(file), file)))
+            except pg.error:
+                warn(f"unable to load, {file}")
+
+    def poll_thumbnails(self, limit=4):
+        """
+        デコード済みのサムネイルを最大limit枚だけ変換・縮小して登録する
+        (convertは表示と同じスレッドで行う必要がある)
+        戻り値: bool : 新しく登録されたサムネイルがあればTrue
+        """
+        added = False
+        for _ in range(limit):
+            try:
+                key, surface = self.decoded.get_nowait()
+            except queue.Empty:
+                break
+            surface = surface.convert()
+            colorkey = self.infos[key].get("colorkey")
+            if colorkey is not None:
+                surface.set_colorkey(colorkey)
+            rect = surface.get_rect().fit(pg.Rect((0, 0), THUMBNAIL_SIZE))
+            self.thumbnails[key] = pg.transform.scale(surface, rect.size)
+            added = True
+        return added
+
+    def default(self, side):
+        """
+        side("Player"か"Alien")が最初に使うキャラクターのキー
+        """
+        key = DEFAULT_CHARACTERS[side]
+        return key if key in self.infos else self.keys[0]
+
+    def get(self, key):
+        """
+        CharacterPackを返す。キャッシュに無ければ読み込み、古いものから追い出す
+        """
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        pack = CharacterPack(key, self.infos[key])
+        self.cache[key] = pack
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return pack
+
+
+class Assets:
+    """
+    共通の画像・効果音・背景・フォントとキャラクター一覧を一度だけ読み込んで保持するクラス
+    再戦のたびにデコードし直さないよう、プロセスの間ずっと使い回す。
+    読み込みは段階(steps)に分けてあり、各段階はファイルを読んで展開する「デコード」と、
+    その結果をconvertしてクラスに登録する「仕上げ」からなる。
+    background=Trueならデコードを別スレッドで始めてすぐに戻るので、poll()を呼んで仕上げを進める
+    (convertは表示と同じスレッドで行う必要がある)。Falseならその場ですべて読み込む。
+    """
+
+    def __init__(self, background=False):
+        self.background = None
+        self.star_strip = None  # Starfieldの一番奥の層の帯
+        self.characters = None
+        self.explosion_sound = None
+        self.item_sound = None
+        self.music = None
+        self.steps = [  # (名前, デコード(Noneなら仕上げだけ), 仕上げ)。仕上げはこの順に行う
+            ("atlas", ATLAS.decode, ATLAS.load),
+            ("fonts", self.decode_fonts, None),
+            ("sprites", None, self.load_sprites),
+            ("background", self.decode_background, self.load_background),
+            ("sounds", self.decode_sounds, self.load_sounds),
+            ("characters", CharacterCatalog, self.load_characters),
+        ]
+        self.decoded: "queue.Queue" = queue.Queue()
+        self.finished = 0  # 仕上げまで終わった段階の数
+        self.loader = None
+        if background:
+            self.loader = threading.Thread(target=self.run, daemon=True)
+            self.loader.start()
+        else:
+            self.run()
+            self.poll()
+
+    @property
+    def progress(self):
+        return self.finished / len(self.steps)
+
+    def run(self):
+        """
+        各段階のデコードを順に行い、結果をキューに入れる
+        """
+        for index, (_, decode, _) in enumerate(self.steps):
+            started = time.perf_counter()
+            try:
+                result = decode() if decode is not None else None
+            except BaseException as e:  # 画像が無いときのSystemExitなども、表示と同じスレッドで投げ直す
+                self.decoded.put((index, e, 0.0))
+                return
+            self.decoded.put((index, result, (time.perf_counter() - started) * 1000))
+
+    def poll(self, timeout=0):
+        """
+        デコードの済んだ段階の仕上げを行う。まだ1つも済んでいなければtimeout秒まで待つ
+        戻り値: bool : すべての段階が終わっていればTrue
+        """
+        while self.finished < len(self.steps):
+            try:
+                index, result, decode_ms = self.decoded.get(timeout=timeout) if timeout else self.decoded.get_nowait()
+            except queue.Empty:
+                break
+            timeout = 0
+            if isinstance(result, BaseException):
+                raise result
+            name, decode, finish = self.steps[index]
+            started = time.perf_counter()
+            if decode is None:
+                finish()
+            elif finish is not None:
+                finish(result)
+            finish_ms = (time.perf_counter() - started) * 1000
+            thread = "loader" if self.loader is not None else "main"
+            STARTUP.mark(name, f"decode {decode_ms:.1f} ms in {thread}, finish {finish_ms:.1f} ms")
+            self.finished += 1
+        return self.finished == len(self.steps)
+
+    def decode_fonts(self):
+        if pg.font:
+            for size, italic in PRELOAD_FONTS:
+                get_font(size, italic)
+
+    def load_sprites(self):
+        # Load images, assign to sprite classes
+        img = load_image("explosion1.gif")
+        Explosion.images = [img, pg.transform.flip(img, 1, 1)]
+        ParticleSystem.bake(img)
+        Bomb.images = [load_image("bomb.gif")]
+        Bomb.mask = pg.mask.from_surface(Bomb.images[0])
+        Shot.images = [load_image("shot.gif")]
+        Shot.mask = pg.mask.from_surface(Shot.images[0])
+        Item.prepare(load_image("item.png"))  # アイテム画像を読み込む
+        Win.images = {"Player": load_image("player_win.png"), "Alien": load_image("alien_win.png")}
+        for winner in Win.images:
+            Win.surfaces[winner] = Win.render(winner)
+
+    def decode_background(self):
+        # 元の画像(1920x1080)は大きいので、使う部分だけを切り出してからconvertする
+        image = decode_image("utyuu.jpg")
+        background = pg.Surface(SCREENRECT.size)
+        background.blit(image, (0, 0))
+        return background, Starfield.make_strip(image)
+
+    def load_background(self, decoded):
+        background, strip = decoded
+        self.background = background.convert()
+        self.star_strip = strip.convert()
+
+    def decode_sounds(self):
+        #ゲーム内効果音(キャラクターごとの発射音はCharacterPackが持つ)
+        return load_sound("Explosion.wav"), load_sound("power_up.mp3")
+
+    def load_sounds(self, sounds):
+        self.explosion_sound, self.item_sound = sounds
+        if pg.mixer:
+            self.music = find_asset("data/game_music.mp3")  # バンドルの場合は再生中ずっと参照が必要
+            pg.mixer.music.load(self.music, "game_music.mp3")
+
+    def load_characters(self, catalog):
+        self.characters = catalog
+        self.characters.start_thumbnails()
+
+
+class Splash:
+    """
+    起動してすぐに出す画面。素材の読み込み中は進み具合をバーで表示する
+    フォントも画像もまだ読み込んでいないので、塗りつぶしと矩形だけで描く。
+    """
+
+    def __init__(self, presenter):
+        self.presenter = presenter
+        self.bar = pg.Rect((0, 0), SPLASH_BAR_SIZE)
+        self.bar.center = SCREENRECT.center
+
+    def draw(self, progress):
+        screen = self.presenter.surface
+        screen.fill("black")
+        pg.draw.rect(screen, "white", self.bar, 1)
+        filled = self.bar.inflate(-4, -4)
+        filled.width = int(filled.width * progress)
+        screen.fill("white", filled)
+        self.presenter.present()
+        STARTUP.mark("first frame")
+
+    def run(self, assets):
+        """
+        assetsの読み込みが終わるまで、仕上げを進めながら進み具合を描く
+        戻り値: bool : 途中で閉じられたらFalse
+        """
+        while True:
+            for event in pg.event.get():
+                if event.type == pg.QUIT or (event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE):
+                    return False
+            done = assets.poll(timeout=1 / FRAME_RATE)
+            self.draw(assets.progress)
+            if done:
+                return True
+
+
+class Snapshot:
+    """
+    シミュレーションの1ティック分の描画内容
+    作った後は書き換えないので、描画側のスレッドはロック無しで読める。
+    sprites, particles : tuple : Surface.blitsにそのまま渡せる(画像, 位置)の並び(位置は画面の座標)
+    camera : tuple : そのときのカメラの左上(対戦の場の座標)
+    """
+
+    __slots__ = ("tick", "time", "sprites", "particles", "camera")
+
+    def __init__(self, tick, time, sprites, particles, camera):
+        self.tick = tick
+        self.time = time
+        self.sprites = sprites
+        self.particles = particles
+        self.camera = camera
+
+
+class SimulationThread:
+    """
+    PlaySceneのシミュレーション(step)を別スレッドでSIMULATION_RATE回/秒で進めるクラス
+    毎ティック後にSnapshotを作って2つの枠の片方に置き、公開する枠を切り替える。
+    描画側(メインスレッド)はlatest()で最新のものを受け取って描くだけなので、
+    描画や画面の更新が遅れてもシミュレーションは止まらない。
+    statsには描画時のスナップショットの古さと、描画されずに飛ばされたティックの数を記録する。
+    """
+
+    def __init__(self, scene, rate=SIMULATION_RATE):
+        self.scene = scene
+        self.interval = 1 / rate
+        self.snapshots: List[Snapshot] = [None, None]
+        self.front = 0  # 公開している枠
+        self.tick = 0
+        self.finished = False
+        self.running = threading.Event()  # 一時停止中はclear
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.last_rendered = 0
+        self.stats = {"ticks": 0, "renders": 0, "skipped": 0, "repeated": 0, "age_total_ms": 0.0, "age_max_ms": 0.0}
+
+    def start(self):
+        self.running.set()
+        self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        self.running.set()
+        if self.thread.is_alive() and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def pause(self):
+        self.running.clear()
+
+    def resume(self):
+        self.running.set()
+
+    def run(self):
+        next_time = time.perf_counter()
+        while not self.stopped:
+            if not self.running.is_set():
+                self.running.wait()
+                next_time = time.perf_counter()  # 止まっていた間のティックを取り戻そうとしない
+                continue
+            now = time.perf_counter()
+            if now < next_time:
+                time.sleep(next_time - now)
+                continue
+            next_time += self.interval
+            if now - next_time > self.interval * 5:
+                next_time = now  # 大きく遅れたら追いつくのをあきらめる
+            scene = self.scene
+            scene.game.sound.tick()
+            scene.step(scene.game.input.take())
+            self.tick += 1
+            self.publish()
+            if scene.done():
+                self.finished = True
                 return
-            if event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE:
+
+    def publish(self):
+        """
+        今の状態からSnapshotを作り、公開していない方の枠に置いてから公開を切り替える
+        """
+        scene = self.scene
+        scene.cull()
+        view = scene.camera.view
+        sprites = tuple(scene.sprite_sequence(copy_mutable=True))
+        particles = tuple(scene.particles.sequence(view))
+        scene.particles.adjust_limit()
+        back = 1 - self.front
+        self.snapshots[back] = Snapshot(self.tick, time.perf_counter(), sprites, particles, view.topleft)
+        self.front = back
+        self.stats["ticks"] += 1
+
+    def latest(self):
+        """
+        最新のSnapshotを返し、古さと飛ばされたティックを記録する
+        """
+        snapshot = self.snapshots[self.front]
+        if snapshot is None:
+            return None
+        stats = self.stats
+        stats["renders"] += 1
+        if snapshot.tick == self.last_rendered:
+            stats["repeated"] += 1
+        else:
+            stats["skipped"] += max(0, snapshot.tick - self.last_rendered - 1)
+        self.last_rendered = snapshot.tick
+        age = (time.perf_counter() - snapshot.time) * 1000
+        stats["age_total_ms"] += age
+        stats["age_max_ms"] = max(stats["age_max_ms"], age)
+        return snapshot
+
+    def report(self):
+        stats = self.stats
+        average = stats["age_total_ms"] / max(1, stats["renders"])
+        return (
+            f"simulation: ticks {stats['ticks']}, renders {stats['renders']}, skipped ticks {stats['skipped']}, "
+            f"repeated snapshots {stats['repeated']}, snapshot age avg {average:.1f} ms max {stats['age_max_ms']:.1f} ms"
+        )
+
+
+class MemoryMonitor:
+    """
+    メモリの使い方を見張るクラス(--memoryを付けて起動したときだけ使う)
+    ・MEMORY_SAMPLE_INTERVALごとに、tracemallocで数えたPythonのメモリ、常駐メモリ、
+      対戦のスプライトグループとパーティクルの数をsamplesに記録する
+    ・対戦の開始ごとにtracemallocのスナップショットを取り、前の対戦の開始からの増え方を
+      このファイルの行(そのメモリを確保した一番内側の行)ごとにまとめる
+    ・MEMORY_GROWTH_MATCHES回続けてMEMORY_GROWTH_THRESHOLDより増えたら、増えた行を警告として表示する
+    Surfaceの画素はSDLが確保するのでtracemallocには映らず、常駐メモリの増え方にだけ現れる。
+    """
+
+    def __init__(self, interval=MEMORY_SAMPLE_INTERVAL):
+        tracemalloc.start(MEMORY_TRACE_FRAMES)
+        self.interval = interval
+        self.samples = deque(maxlen=MEMORY_MAX_SAMPLES)
+        self.last_sample = 0
+        self.matches: List[tuple] = []  # 対戦の開始ごとの(Pythonのメモリ, 常駐メモリ)
+        self.snapshot = None  # 前の対戦の開始時のスナップショット
+        self.growth: List[tuple] = []  # 前の対戦から増えた行の上位
+        self.warnings: List[str] = []
+        # 記録そのものが使うメモリは数えないよう、このクラスとresident_bytes()の行を除く
+        self.own_lines = set()
+        for function in [resident_bytes, *vars(MemoryMonitor).values()]:
+            code = getattr(function, "__code__", None)
+            if code is not None:
+                self.own_lines.update(line for _, _, line in code.co_lines() if line is not None)
+
+    def sample(self, scene):
+        """
+        前の記録からintervalミリ秒たっていれば、今の使用量とsceneのグループの大きさを記録する
+        """
+        now = pg.time.get_ticks()
+        if now - self.last_sample < self.interval:
+            return
+        self.last_sample = now
+        traced, peak = tracemalloc.get_traced_memory()
+        groups = {name: len(getattr(scene, name)) for name in ("all", "shots", "bombs", "items")}
+        groups["particles"] = scene.particles.count
+        self.samples.append((now, traced, peak, resident_bytes(), groups))
+
+    def sites(self, stats, limit=10):
+        """
+        tracemallocの統計(StatisticかStatisticDiff)を、このファイルの一番内側の行ごとに足し合わせ、
+        大きい順に(バイト数, 個数, 場所)を返す
+        """
+        totals: Dict[str, list] = {}
+        for stat in stats:
+            frame = next((frame for frame in reversed(stat.traceback) if frame.filename == __file__), None)
+            if frame is None or frame.lineno in self.own_lines:
+                continue
+            code = linecache.getline(frame.filename, frame.lineno).strip()
+            site = f"line {frame.lineno}: {code}"
+            total = totals.setdefault(site, [0, 0])
+            total[0] += getattr(stat, "size_diff", stat.size)
+            total[1] += getattr(stat, "count_diff", stat.count)
+        ranking = sorted(((size, count, site) for site, (size, count) in totals.items()), reverse=True)
+        return ranking[:limit]
+
+    def match_started(self):
+        """
+        対戦の開始時に呼ぶ。前の対戦の開始からの増え方を調べ、続けて増えていれば警告する
+        """
+        gc.collect()  # 循環参照で残っているだけのものは数えない
+        snapshot = tracemalloc.take_snapshot()
+        self.matches.append((tracemalloc.get_traced_memory()[0], resident_bytes()))
+        if self.snapshot is not None:
+            self.growth = self.sites(snapshot.compare_to(self.snapshot, "traceback"))
+        self.snapshot = snapshot
+        recent = [python for python, _ in self.matches[-MEMORY_GROWTH_MATCHES - 1:]]
+        if len(recent) > MEMORY_GROWTH_MATCHES and all(
+            after - before > MEMORY_GROWTH_THRESHOLD for before, after in zip(recent, recent[1:])
+        ):
+            lines = [f"memory grew for {MEMORY_GROWTH_MATCHES} matches in a row ({(recent[-1] - recent[0]) / 1024:.0f} KiB)"]
+            lines += [f"  {size / 1024:+8.1f} KiB {count:+6d} blocks  {site}" for size, count, site in self.growth[:5]]
+            warning = "\n".join(lines)
+            self.warnings.append(warning)
+            warn(warning)
+
+    def report(self):
+        lines = ["memory:"]
+        if self.samples:
+            _, traced, peak, rss, groups = self.samples[-1]
+            sizes = ", ".join(f"{name} {max(sample[4][name] for sample in self.samples)}" for name in groups)
+            lines.append(
+                f"  python {traced / 1024:.0f} KiB (peak {peak / 1024:.0f} KiB), resident {rss / 1048576:.1f} MiB, "
+                f"{len(self.samples)} samples; largest groups: {sizes}"
+            )
+        for number, (python, rss) in enumerate(self.matches, 1):
+            lines.append(f"  match {number}: python {python / 1024:.0f} KiB, resident {rss / 1048576:.1f} MiB at start")
+        if self.growth:
+            lines.append("  growth since the previous match by line:")
+            lines += [f"    {size / 1024:+8.1f} KiB {count:+6d} blocks  {site}" for size, count, site in self.growth]
+        current = tracemalloc.take_snapshot().statistics("traceback")
+        lines.append("  largest allocations by line:")
+        lines += [f"    {size / 1024:8.1f} KiB {count:6d} blocks  {site}" for size, count, site in self.sites(current)]
+        lines.append(f"  warnings: {len(self.warnings)}")
+        return "\n".join(lines)
+
+
+class MatchHistory:
+    """
+    対戦の記録をSQLiteに残すクラス
+    ・record()は1対戦分の記録をキューに入れるだけで、書き込みは別スレッドがたまった分を1回のトランザクションで行う
+    ・matchesには1対戦1行、charactersにはキャラクターごとの通算(対戦数・勝ち数など)を同じトランザクションで足し込む
+    ・ランキングはcharactersから、キャラクターごとの最近の対戦やハイスコアはmatchesの索引から引くので、
+      記録が何十万件になっても数ミリ秒で返る
+    読み出しは呼び出したスレッドで別の接続を開いて行う(WALなので書き込み中でも読める)。
+    """
+
+    SIDES = ("Player", "Alien")
+    KINDS = ("normal", "spread", "speed")
+    COLUMNS = (
+        "played_at", "duration_ms", "winner", "player", "alien", "player_score", "alien_score",
+        "player_normal", "player_spread", "player_speed", "player_items",
+        "alien_normal", "alien_spread", "alien_speed", "alien_items",
+    )
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS matches (
+            id INTEGER PRIMARY KEY,
+            played_at REAL NOT NULL,          -- 決着した時刻(UNIX時間)
+            duration_ms INTEGER NOT NULL,     -- 一時停止を除いた対戦時間
+            winner TEXT NOT NULL,             -- "Player" か "Alien"
+            player TEXT NOT NULL,             -- キャラクターパックのキー
+            alien TEXT NOT NULL,
+            player_score INTEGER NOT NULL,
+            alien_score INTEGER NOT NULL,
+            player_normal INTEGER NOT NULL, player_spread INTEGER NOT NULL,
+            player_speed INTEGER NOT NULL, player_items INTEGER NOT NULL,
+            alien_normal INTEGER NOT NULL, alien_spread INTEGER NOT NULL,
+            alien_speed INTEGER NOT NULL, alien_items INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS matches_player ON matches (player, played_at);
+        CREATE INDEX IF NOT EXISTS matches_alien ON matches (alien, played_at);
+        CREATE INDEX IF NOT EXISTS matches_player_score ON matches (player_score);
+        CREATE INDEX IF NOT EXISTS matches_alien_score ON matches (alien_score);
+        CREATE TABLE IF NOT EXISTS characters (
+            character TEXT PRIMARY KEY,
+            matches INTEGER NOT NULL,
+            wins INTEGER NOT NULL,
+            shots INTEGER NOT NULL,
+            items INTEGER NOT NULL,
+            best_score INTEGER NOT NULL,
+            total_ms INTEGER NOT NULL
+        );
+    """
+
+    def __init__(self, path=HISTORY_FILE):
+        self.path = path
+        self.queue = queue.Queue()
+        self.recorded = 0
+        self.failed = 0  # 書き込めずに捨てた対戦の数
+        self.readers: Dict[int, object] = {}  # スレッドID -> 読み出し用の接続
+        db = sqlite3.connect(path)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(self.SCHEMA)
+        finally:
+            db.close()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def record(self, match):
+        """
+        1対戦分の記録(COLUMNSをキーに持つdict)を書き込み待ちに入れる
+        """
+        self.queue.put(match)
+        self.recorded += 1
+
+    def run(self):
+        db = sqlite3.connect(self.path)
+        while True:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            matches = [match for match in batch if match is not None]
+            if matches:
+                try:
+                    self.write(db, matches)
+                except sqlite3.Error as e:  # ロックされているなどで書けなかった分は捨て、対戦は止めない
+                    self.failed += len(matches)
+                    warn(f"unable to record {len(matches)} matches, {e}")
+            for _ in batch:
+                self.queue.task_done()
+            if len(matches) < len(batch):  # close()が入れたNoneで終わる
+                db.close()
                 return
-            if event.type == pg.KEYDOWN:
-                if event.key == pg.K_h:
-                    if not fullscreen:
-                        print("Changing to FULLSCREEN")
-                        screen_backup = screen.copy()
-                        screen = pg.display.set_mode(SCREENRECT.size, winstyle | pg.FULLSCREEN, bestdepth)
-                        screen.blit(screen_backup, (0, 0))
-                    else:
-                        print("Changing to windowed mode")
-                        screen_backup = screen.copy()
-                        screen = pg.display.set_mode(SCREENRECT.size, winstyle, bestdepth)
-                        screen.blit(screen_backup, (0, 0))
-                    pg.display.flip()
-                    fullscreen = not fullscreen
-
-        keystate = pg.key.get_pressed()
-
-        all.clear(screen, background)
+
+    @classmethod
+    def write(cls, db, matches):
+        """
+        matchesを1回のトランザクションでmatchesとcharactersに書き込む
+        """
+        placeholders = ", ".join("?" * len(cls.COLUMNS))
+        characters = []
+        for match in matches:
+            for side in cls.SIDES:
+                prefix = side.lower()
+                characters.append((
+                    match[prefix], int(match["winner"] == side),
+                    sum(match[f"{prefix}_{kind}"] for kind in cls.KINDS), match[f"{prefix}_items"],
+                    match[f"{prefix}_score"], match["duration_ms"],
+                ))
+        with db:
+            db.executemany(
+                f"INSERT INTO matches ({', '.join(cls.COLUMNS)}) VALUES ({placeholders})",
+                [tuple(match[column] for column in cls.COLUMNS) for match in matches],
+            )
+            db.executemany(
+                """
+                INSERT INTO characters (character, matches, wins, shots, items, best_score, total_ms)
+                VALUES (?, 1, ?, ?, ?, ?, ?)
+                ON CONFLICT (character) DO UPDATE SET
+                    matches = matches + 1,
+                    wins = wins + excluded.wins,
+                    shots = shots + excluded.shots,
+                    items = items + excluded.items,
+                    best_score = max(best_score, excluded.best_score),
+                    total_ms = total_ms + excluded.total_ms
+                """,
+                characters,
+            )
+
+    def flush(self):
+        """
+        書き込み待ちの記録がすべて書かれるまで待つ
+        """
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        for reader in self.readers.values():
+            reader.close()
+        self.readers.clear()
+
+    def reader(self):
+        """
+        呼び出したスレッド用の読み出し用の接続を返す
+        """
+        key = threading.get_ident()
+        if key not in self.readers:
+            self.readers[key] = sqlite3.connect(self.path)
+        return self.readers[key]
+
+    def leaderboard(self, limit=10):
+        """
+        勝ち数の多いキャラクターの順に(キャラクター, 勝ち数, 対戦数, 最高スコア)を返す
+        """
+        return self.reader().execute(
+            "SELECT character, wins, matches, best_score FROM characters ORDER BY wins DESC, matches LIMIT ?",
+            (limit,),
+        ).fetchall()
+
+    def character_stats(self, character, recent=10):
+        """
+        キャラクターの通算(dict)と、PlayerかAlienとして出た最近の対戦を返す
+        """
+        db = self.reader()
+        row = db.execute(
+            "SELECT matches, wins, shots, items, best_score, total_ms FROM characters WHERE character = ?",
+            (character,),
+        ).fetchone()
+        if row is None:
+            return None, []
+        stats = dict(zip(("matches", "wins", "shots", "items", "best_score", "total_ms"), row))
+        matches = db.execute(
+            """
+            SELECT * FROM (SELECT played_at, 'Player', winner, player_score, alien FROM matches
+                           WHERE player = ? ORDER BY played_at DESC LIMIT ?)
+            UNION ALL
+            SELECT * FROM (SELECT played_at, 'Alien', winner, alien_score, player FROM matches
+                           WHERE alien = ? ORDER BY played_at DESC LIMIT ?)
+            ORDER BY 1 DESC LIMIT ?
+            """,
+            (character, recent, character, recent, recent),
+        ).fetchall()
+        return stats, matches
+
+    def high_scores(self, side="Player", limit=10):
+        """
+        sideのスコアが高い対戦の順に(スコア, キャラクター, 時刻)を返す
+        """
+        prefix = "player" if side == "Player" else "alien"
+        return self.reader().execute(
+            f"SELECT {prefix}_score, {prefix}, played_at FROM matches ORDER BY {prefix}_score DESC LIMIT ?",
+            (limit,),
+        ).fetchall()
+
+    def report(self):
+        self.flush()
+        lines = [f"match history: {self.recorded - self.failed} matches recorded in {os.path.basename(self.path)}"
+                 + (f", {self.failed} could not be written" if self.failed else "")]
+        for rank, (character, wins, matches, best) in enumerate(self.leaderboard(3), 1):
+            lines.append(f"  {rank}. {character}: {wins} wins / {matches} matches, best score {best}")
+        return "\n".join(lines)
+
+
+class Scene:
+    """
+    タイトル・対戦・勝利画面などの場面の基底クラス
+    Gameは毎フレーム、イベントをhandle_event()に渡し、update()とdraw()を呼ぶ。
+    """
+
+    def __init__(self, game):
+        self.game = game
+
+    def enter(self):
+        """
+        この場面に切り替わったときに一度だけ呼ばれる
+        """
+
+    def handle_event(self, event):
+        """
+        pg.QUITと全画面切り替え以外のイベントを処理する
+        """
+
+    def update(self):
+        """
+        1フレーム分の状態を進める
+        """
+
+    def draw(self, screen):
+        """
+        画面を描画する
+        """
+
+    def redraw(self):
+        """
+        一時停止から戻ったときなどに画面全体を描き直す
+        """
+
+    def exit(self):
+        """
+        別の場面に切り替わるときに呼ばれる
+        """
+
+    def pause(self):
+        """
+        一時停止したときに呼ばれる
+        """
+
+    def resume(self):
+        """
+        一時停止から戻ったときに呼ばれる(このあとredraw()が呼ばれる)
+        """
+
+
+class TitleScene(Scene):
+    """
+    タイトル画面。[Space]か[Enter]で対戦を開始し、[Esc]で終了する
+    """
+
+    def __init__(self, game):
+        super().__init__(game)
+        self.image = game.assets.background.copy()
+        if pg.font:
+            font = get_font(64)
+            text = font.render("Koukaton Star Shoot", True, "white")
+            self.image.blit(text, text.get_rect(center=(SCREENRECT.centerx, SCREENRECT.centery - 40)))
+            font = get_font(32)
+            text = font.render("Press SPACE to start", True, "white")
+            self.image.blit(text, text.get_rect(center=(SCREENRECT.centerx, SCREENRECT.centery + 40)))
+
+    def enter(self):
+        self.game.screen.blit(self.image, (0, 0))
+        self.game.present()
+        STARTUP.mark("playable")  # タイトル画面が出たら、キーを受け付けられる
+
+    def handle_event(self, event):
+        if event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE:
+            self.game.quit()
+        elif event.type == pg.KEYDOWN and event.key in (pg.K_SPACE, pg.K_RETURN):
+            self.game.change(self.game.select)
+
+    def update(self):
+        self.game.assets.characters.poll_thumbnails()  # タイトル表示中にも選択画面の準備を進める
+
+    def draw(self, screen):
+        pass  # 静止画なのでenter()での描画だけでよい
+
+    def redraw(self):
+        self.enter()
+
+
+class SelectScene(Scene):
+    """
+    キャラクター選択画面
+    Playerは[←][→]で選んで[Enter]、Alienは[A][D]で選んで[T]で決定する。
+    サムネイルは読み込みが終わったものから順に表示する。
+    """
+
+    columns = 8
+    cell = 76  # サムネイル1枠の大きさ
+    top = 120
+
+    def __init__(self, game):
+        super().__init__(game)
+        self.catalog = game.assets.characters
+        keys = self.catalog.keys
+        self.cursor = {side: keys.index(self.catalog.default(side)) for side in ("Player", "Alien")}
+        self.chosen: Dict[str, bool] = {}
+        self.font = get_font(28) if pg.font else None
+        self.dirty = True
+
+    def enter(self):
+        self.chosen = {"Player": False, "Alien": False}
+        self.dirty = True
+
+    def cell_rect(self, index):
+        left = (SCREENRECT.width - self.columns * self.cell) // 2
+        row, col = divmod(index, self.columns)
+        return pg.Rect(left + col * self.cell, self.top + row * self.cell, self.cell, self.cell)
+
+    def redraw(self):
+        self.dirty = True
+
+    def move(self, side, step):
+        if not self.chosen[side]:
+            self.cursor[side] = (self.cursor[side] + step) % len(self.catalog.keys)
+            self.dirty = True
+
+    def choose(self, side):
+        self.chosen[side] = True
+        self.dirty = True
+        if all(self.chosen.values()):
+            catalog = self.catalog
+            play = self.game.play
+            play.player_pack = catalog.get(catalog.keys[self.cursor["Player"]])
+            play.alien_pack = catalog.get(catalog.keys[self.cursor["Alien"]])
+            self.game.change(play)
+
+    def handle_event(self, event):
+        if event.type != pg.KEYDOWN:
+            return
+        if event.key == pg.K_ESCAPE:
+            self.game.change(self.game.title)
+        elif event.key == pg.K_LEFT:
+            self.move("Player", -1)
+        elif event.key == pg.K_RIGHT:
+            self.move("Player", 1)
+        elif event.key == pg.K_RETURN:
+            self.choose("Player")
+        elif event.key == pg.K_a:
+            self.move("Alien", -1)
+        elif event.key == pg.K_d:
+            self.move("Alien", 1)
+        elif event.key == pg.K_t:
+            self.choose("Alien")
+
+    def update(self):
+        if self.catalog.poll_thumbnails():
+            self.dirty = True
+
+    def draw(self, screen):
+        if not self.dirty:
+            return
+        self.dirty = False
+        screen.blit(self.game.assets.background, (0, 0))
+        catalog = self.catalog
+        for index, key in enumerate(catalog.keys):
+            rect = self.cell_rect(index)
+            thumbnail = catalog.thumbnails.get(key)
+            if thumbnail is not None:
+                screen.blit(thumbnail, thumbnail.get_rect(center=rect.center))
+        colors = {"Player": "deepskyblue", "Alien": "red"}
+        for side, color in colors.items():
+            width = 5 if self.chosen[side] else 2
+            inset = 2 if side == "Player" else 6
+            pg.draw.rect(screen, color, self.cell_rect(self.cursor[side]).inflate(-inset, -inset), width)
+        if self.font:
+            for side, y in (("Alien", 40), ("Player", SCREENRECT.height - 60)):
+                name = catalog.infos[catalog.keys[self.cursor[side]]].get("name", "")
+                mark = " OK" if self.chosen[side] else ""
+                text = self.font.render(f"{side}: {name}{mark}", True, colors[side])
+                screen.blit(text, text.get_rect(center=(SCREENRECT.centerx, y)))
+        self.game.present()
+
+
+class PlayScene(Scene):
+    """
+    対戦画面
+    スプライトグループは一度だけ作り、reset()で中身を入れ替えて再戦に使い回す。
+    allのスプライトは対戦の場(ARENARECT)の座標で動き、カメラに映るものだけを描く。
+    ゲージやスコアはhudに入れ、カメラに関係なく画面の決まった位置に描く。
+    """
+
+    def __init__(self, game):
+        super().__init__(game)
+        self.shots = pg.sprite.Group()
+        self.bombs = pg.sprite.Group()
+        self.items = pg.sprite.Group()
+        self.grid = SpatialGrid()
+        self.all = ArenaGroup(self.grid)
+        self.hud = pg.sprite.Group()
+        self.camera = Camera()
+        self.focus = ()  # カメラが追うスプライト
+        self.visible: List[pg.sprite.Sprite] = []  # カメラに映っているallのスプライト
+        self.drawn_camera = (0, 0)  # 前回描いたときのカメラの左上
+        self.player = None
+        self.alien = None
+        self.player_pack = None
+        self.alien_pack = None
+        self.particles = ParticleSystem()
+        self.starfield = Starfield(game.assets.star_strip)
+        self.full_redraw = False  # 背景が動いて画面全体の更新が必要なフレームならTrue
+        self.simulation = None  # 別スレッドでシミュレーションするときのSimulationThread
+        self.sprite_rects: List[pg.Rect] = []  # 前回スプライトを描いた範囲(画面の座標)
+        self.winner = None
+        self.finish_time = 0
+        self.item_timer = 0
+        self.tick = 0  # 対戦が始まってからのティック数(出来事のログに使う)
+        self.hud_interval = 1  # ゲージやスコアを更新する間隔(ティック)。品質を下げると長くなる
+        self.gauge_values = {}  # 最後にログに書いたゲージの値
+        self.started = 0  # 対戦が始まった時刻(get_ticks)
+        self.shot_counts = {}  # 陣営 -> 弾の種類 -> 撃った回数(対戦の記録に使う)
+        self.item_counts = {}  # 陣営 -> 取ったアイテムの数
+
+    def reset(self):
+        """
+        スコア・速度・スプライトを初期状態に戻して新しい対戦を用意する
+        画像や効果音は読み込み直さないので1フレームより十分短い時間で終わる。
+        """
+        global PLAYER_SCORE, ALIEN_SCORE
+        PLAYER_SCORE = 0
+        ALIEN_SCORE = 0
+        for group in (self.shots, self.bombs, self.items, self.all, self.hud):
+            group.empty()
+        self.particles.clear()
+        self.winner = None
+
+        catalog = self.game.assets.characters
+        if self.player_pack is None:
+            self.player_pack = catalog.get(catalog.default("Player"))
+        if self.alien_pack is None:
+            self.alien_pack = catalog.get(catalog.default("Alien"))
+
+        all = self.all
+        self.player = Player(self.player_pack, all)
+        self.alien = Alien(self.alien_pack, all)
+
+        self.hud.add(self.player.gauge)  # プレイヤーのゲージを追加
+        self.hud.add(self.alien.gauge)  # エイリアンのゲージを追加
+
+        Item(self.items, all)  # アイテムを初期化し追加
+
+        if pg.font:
+            PlayerScore(self.hud)
+            AlienScore(self.hud)
+
+        self.tick = 0
+        self.gauge_values = {"Player": 0, "Alien": 0}
+        self.shot_counts = {side: dict.fromkeys(MatchHistory.KINDS, 0) for side in MatchHistory.SIDES}
+        self.item_counts = dict.fromkeys(MatchHistory.SIDES, 0)
+        EVENTS.log("match_start", 0, player=self.player_pack.key, alien=self.alien_pack.key)
+
+        self.focus = (self.player, self.alien)
+        self.camera.reset(self.focus)
+        self.drawn_camera = self.camera.view.topleft
+        self.visible = []
+        self.item_timer = get_ticks()
+        self.started = self.item_timer
+
+    def enter(self):
+        self.reset()
+        self.game.input.clear()  # タイトルや選択画面で押したキーを対戦に持ち込まない
+        self.game.latency.clear()
+        if self.game.memory is not None:
+            self.game.memory.match_started()
+        assets = self.game.assets
+        self.starfield.redraw(self.game.screen)
+        self.game.present()
+        if assets.music:
+            self.game.sound.play_music()
+        self.sprite_rects = []
+        if self.game.threaded:
+            self.simulation = SimulationThread(self)
+            self.simulation.start()
+
+    def exit(self):
+        if self.simulation is not None:
+            self.simulation.stop()
+            self.game.simulation_reports.append(self.simulation.report())
+            self.simulation = None
+
+    def pause(self):
+        if self.simulation is not None:
+            self.simulation.pause()
+
+    def resume(self):
+        if self.simulation is not None:
+            self.simulation.resume()
+
+    def handle_event(self, event):
+        if event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE:
+            self.game.quit()
+
+    def redraw(self):
+        self.starfield.redraw(self.game.screen)
+        self.sprite_rects = []
+        self.game.present()
+
+    def cull(self):
+        """
+        カメラを進め、映っているスプライトを格子から探してvisibleに入れる
+        アニメーションも映っているスプライトの分だけ進める。
+        """
+        self.camera.follow(sprite for sprite in self.focus if sprite.alive())
+        self.grid.refresh()
+        self.visible = self.grid.query(self.camera.view)
+        for sprite in self.visible:
+            animate = getattr(sprite, "animate", None)
+            if animate is not None:
+                animate()
+
+    def sprite_sequence(self, copy_mutable=False):
+        """
+        映っているスプライトとhudを、Surface.blitsに渡す(画像, 画面の座標)の並びにする
+        copy_mutable : bool : Trueならimage_is_mutableのスプライトの画像はコピーする(スナップショット用)
+        """
+        view = self.camera.view
+        sequence = [(sprite.image, sprite.rect.move(-view.x, -view.y)) for sprite in self.visible]
+        for sprite in self.hud:
+            image = sprite.image
+            if copy_mutable and getattr(sprite, "image_is_mutable", False):
+                image = image.copy()
+            sequence.append((image, sprite.rect))
+        return sequence
+
+    def pan(self, camera):
+        """
+        前回描いたときからカメラが動いた分だけ星をずらす
+        """
+        x, y = camera
+        last_x, last_y = self.drawn_camera
+        self.starfield.pan(x - last_x, y - last_y)
+        self.drawn_camera = camera
+
+    def draw_snapshot(self, screen):
+        """
+        シミュレーションのスレッドが公開した最新のスナップショットを描く
+        """
+        snapshot = self.simulation.latest()
+        if snapshot is None:
+            return
+        starfield = self.starfield
+        starfield.clear(screen)
+        background = starfield.background
+        screen.blits([(background, rect, rect) for rect in self.sprite_rects], doreturn=False)
+        full_redraw = starfield.scroll(screen)
+        self.pan(snapshot.camera)
+        dirty = starfield.draw(screen)
+        rects = screen.blits(snapshot.sprites) + screen.blits(snapshot.particles)
+        dirty += self.sprite_rects + rects
+        self.sprite_rects = rects
+        self.game.present(None if full_redraw else dirty)
+        self.game.latency.presented(snapshot.tick)
+
+    def finish(self, winner, actor, hit):
+        """
+        決着がついたら効果音を鳴らして爆発させ、FINISH_TIMEミリ秒後に勝利画面に切り替える
+        """
+        sound = self.game.sound
+        sound.play(self.game.assets.explosion_sound, SOUND_PRIORITY_EXPLOSION)
+        sound.stop_music()
+        self.focus = (Explosion(actor, self.all),)  # 爆発が消えるまでカメラで追う
+        self.particles.burst(actor.rect.center, 1200, "debris", speed=7.0, life=40)
+        self.particles.burst(hit.rect.center, 600, "spark", speed=9.0, life=25)
+        actor.kill()
+        self.winner = winner
+        self.finish_time = get_ticks()
+        self.log_gauges()
+        EVENTS.log("hit", self.tick, winner=winner, by=type(hit).__name__,
+                   player_score=PLAYER_SCORE, alien_score=ALIEN_SCORE)
+        if self.game.history is not None:
+            self.game.history.record(self.match_record())
+
+    def match_record(self):
+        """
+        終わった対戦の記録をMatchHistory.COLUMNSをキーに持つdictにする
+        """
+        record = {
+            "played_at": time.time(), "duration_ms": self.finish_time - self.started, "winner": self.winner,
+            "player": self.player_pack.key, "alien": self.alien_pack.key,
+            "player_score": PLAYER_SCORE, "alien_score": ALIEN_SCORE,
+        }
+        for side in MatchHistory.SIDES:
+            prefix = side.lower()
+            for kind, count in self.shot_counts[side].items():
+                record[f"{prefix}_{kind}"] = count
+            record[f"{prefix}_items"] = self.item_counts[side]
+        return record
+
+    def shoot(self, side, kind, cls, groups, pressed=None):
+        """
+        sideのキャラクターパックのkindの撃ち方でcls(ShotかBomb)の弾を撃ち、数えて出来事のログに書く
+        aimedの撃ち方は相手の中心を狙う。spiralは何回目に撃ったかで向きが回る。
+        このティックで押したキーで撃ったなら、押した時刻pressedから入力の遅れを測る。
+        """
+        if pressed is not None:
+            self.game.latency.fired(pressed, self.tick)
+        actor, target = (self.player, self.alien) if side == "Player" else (self.alien, self.player)
+        pattern = actor.pack.patterns[kind]
+        angles = pattern.fire(cls, actor.gunpos(), groups, self.shot_counts[side][kind], target.rect.center)
+        self.shot_counts[side][kind] += 1
+        if len(angles) > 1:
+            EVENTS.log("fire", self.tick, side=side, kind=kind, count=len(angles), angles=angles)
+        else:
+            EVENTS.log("fire", self.tick, side=side, kind=kind)
+
+    def picked(self, side, score):
+        """
+        取ったアイテムを数えて出来事のログに書く
+        """
+        self.item_counts[side] += 1
+        EVENTS.log("item", self.tick, side=side, score=score)
+
+    def erase(self):
+        """
+        前のフレームで描いた星・スプライト・パーティクルを消し、背景を進める
+        画面全体を描き直すのは背景が動いたフレームだけ
+        """
+        screen = self.game.screen
+        starfield = self.starfield
+        starfield.clear(screen)
+        background = starfield.background
+        screen.blits([(background, rect, rect) for rect in self.sprite_rects], doreturn=False)
+        self.particles.erase(screen, background)
+        self.full_redraw = starfield.scroll(screen)
+
+    def done(self):
+        """
+        決着後の爆発を見せ終わったらTrue
+        """
+        return self.winner is not None and get_ticks() - self.finish_time > FINISH_TIME
+
+    def show_winner(self):
+        self.game.win.winner = self.winner
+        self.game.change(self.game.win)
+
+    def update(self):
+        if self.simulation is not None:
+            # シミュレーションは別スレッドで進み、入力もそちらでgame.inputから取るので、決着を確認するだけ
+            if self.simulation.finished:
+                self.show_winner()
+            return
+        self.erase()
+        self.step(self.game.input.take())
+        if self.done():
+            self.show_winner()
+
+    def log_gauges(self):
+        """
+        前に書いたときから変わったゲージの値を出来事のログに書く
+        """
+        for side, actor in (("Player", self.player), ("Alien", self.alien)):
+            value = actor.gauge.current_value
+            if value != self.gauge_values[side]:
+                self.gauge_values[side] = value
+                EVENTS.log("gauge", self.tick, side=side, value=value)
+
+    def step(self, keystate):
+        """
+        1ティック分ゲームを進める。画面には触れないので別スレッドからも呼べる
+        """
+        self.tick += 1
+        if self.winner is not None:
+            # 決着後は操作を受け付けず、爆発だけを動かす
+            self.all.update()
+            self.particles.update()
+            return
+        game = self.game
+        assets = game.assets
+        sound = game.sound
+        shots, bombs, items, all = self.shots, self.bombs, self.items, self.all
+        player, alien = self.player, self.alien
+
         all.update()
+        if self.tick % self.hud_interval == 0:
+            self.hud.update()
 
+        # カメラに映る範囲の外へは出られないので、2人とも常に画面に映る
         direction = keystate[pg.K_RIGHT] - keystate[pg.K_LEFT]
-        player.move(direction)
-        
-        player.gauge.update()
+        player.move(direction, self.camera.view)
+
         player.gauge.increase()
-        
+
         #pleyerのshotに関しての情報
         player_firing = keystate[pg.K_RETURN]
         player_spread = keystate[pg.K_l]
         player_shot_speed = keystate[pg.K_k]
         if not player.reloading and player_firing and len(shots) < MAX_SHOTS and player.gauge.can_fire():
-            shot = Shot(player.gunpos(), 0,  shots, all)
-            if pg.mixer and shoot_sound is not None:
-                shoot_sound.play()
+            self.shoot("Player", "normal", Shot, (shots, all), keystate.pressed_at(pg.K_RETURN))
+            sound.play(player.pack.sounds.get("shot"))
             player.gauge.current_value -= 2
         elif not player.reloading and player_spread and len(shots) < MAX_SHOTS and PLAYER_SCORE >= 2 and player.gauge.spread_can_fire():#spread_shotが打てるようになる
-            shot_list = [Shot(player.gunpos(), 0,  shots, all) for i in range(3)]
-            dxs = [-1, 0, 1]
-            spread = 5
-            count = 3
-            start_angle = -spread * (count - 1) / 2
-            for i in range(count):
-                # shot_list[i].angle = start_angle + spread * i
-                shot_list[i].dx = dxs[i]
-            
-            if pg.mixer and shoot_sound is not None:
-                shoot_sound.play()
+            self.shoot("Player", "spread", Shot, (shots, all), keystate.pressed_at(pg.K_l))
+            sound.play(player.pack.sounds.get("shot"), SOUND_PRIORITY_SPECIAL)
             player.gauge.current_value -= 6
         elif not player.reloading and player_shot_speed and len(shots) < MAX_SHOTS and PLAYER_SCORE >= 4 and player.gauge.speed_can_fire():#speed_shotが打てるようになる
-            shot = Speed_shot(player.gunpos(), 0, shots, all)
-            if pg.mixer and shoot_sound is not None:
-                beem_sound.play()
+            self.shoot("Player", "speed", Speed_shot, (shots, all), keystate.pressed_at(pg.K_k))
+            sound.play(player.pack.sounds.get("speed"), SOUND_PRIORITY_SPECIAL)
             player.gauge.current_value -= 8
         player.reloading = player_firing
 
         direction = keystate[pg.K_d] - keystate[pg.K_a]
-        alien.move(direction)
-        
-        alien.gauge.update()
+        alien.move(direction, self.camera.view)
+
         alien.gauge.increase()
-        
+
         #alienのbombに関しての情報
         alien_firing = keystate[pg.K_t]
         alien_spread = keystate[pg.K_r]
         alien_shot_speed = keystate[pg.K_e]
         if not alien.reloading and alien_firing and len(bombs) < MAX_BOMBS and alien.gauge.can_fire():
-            bomb = Bomb(alien.gunpos(), 0, bombs, all)
-            if pg.mixer and shoot_sound is not None:
-                boom_sound.play()
+            self.shoot("Alien", "normal", Bomb, (bombs, all), keystate.pressed_at(pg.K_t))
+            sound.play(alien.pack.sounds.get("shot"))
             alien.gauge.current_value -= 2
         elif not alien.reloading and alien_spread and len(bombs) < MAX_BOMBS and ALIEN_SCORE >= 2 and alien.gauge.spread_can_fire():#spread_shotが打てるようになる
-            bomb_list = [Bomb(alien.gunpos(), 0,  bombs, all) for i in range(3)]
-            dxs = [-1, 0, 1]
-            spread = 3
-            count = 3
-            start_angle = -spread * (count - 1) / 2
-            for i in range(count):
-                bomb_list[i].angle = start_angle + spread * i
-                bomb_list[i].dx = dxs[i]
-                print(bomb_list[i].angle)
-                
-            if pg.mixer and boom_sound is not None:
-                boom_sound.play()
+            self.shoot("Alien", "spread", Bomb, (bombs, all), keystate.pressed_at(pg.K_r))
+            sound.play(alien.pack.sounds.get("shot"), SOUND_PRIORITY_SPECIAL)
             alien.gauge.current_value -= 6
         elif not alien.reloading and alien_shot_speed and len(bombs) < MAX_BOMBS and ALIEN_SCORE >= 4 and alien.gauge.speed_can_fire():#speed_shotが打てるようになる
-            bomb = Speed_bomb(alien.gunpos(), 0, bombs, all)
-            if pg.mixer and boom_sound is not None:
-                bomb_special.play()
+            self.shoot("Alien", "speed", Speed_bomb, (bombs, all), keystate.pressed_at(pg.K_e))
+            sound.play(alien.pack.sounds.get("speed"), SOUND_PRIORITY_SPECIAL)
             alien.gauge.current_value -= 8
         alien.reloading = alien_firing
 
         for shot in pg.sprite.spritecollide(alien, shots, 1, pg.sprite.collide_mask):
-            Explosion(shot, all)
-            Explosion(alien, all)
-            if pg.mixer and boom_sound is not None:
-                explosion_sound.play()
-                pg.mixer.music.stop()
-            all.add(Win("Player"))
-            all.draw(screen)
-            pg.display.flip()
-            pg.time.wait(5000)
-            alien.kill()
+            self.finish("Player", alien, shot)
             return
 
         for bomb in pg.sprite.spritecollide(player, bombs, 1):
-            Explosion(bomb, all)
-            Explosion(player, all)
-            if pg.mixer and boom_sound is not None:
-                explosion_sound.play()
-                pg.mixer.music.stop()
-            player.kill()
-            # Display win screen for alien
-            all.add(Win("Alien"))
-            all.draw(screen)
-            pg.display.flip()
-            pg.time.wait(5000)
+            self.finish("Alien", player, bomb)
             return
-        
-        all.add(player.gauge)  # プレイヤーのゲージを毎フレーム追加する
-        all.add(alien.gauge)  # エイリアンのゲージを毎フレーム追加する
 
-        # draw the scene
-        dirty = all.draw(screen)
-        pg.display.update(dirty)
-        
-        current_time = pg.time.get_ticks()
-        if len(items) < MAX_ITEMS_ON_SCREEN and current_time - item_timer > ITEM_SPAWN_INTERVAL:
+        self.particles.update()
+
+        current_time = get_ticks()
+        if len(items) < MAX_ITEMS_ON_SCREEN and current_time - self.item_timer > ITEM_SPAWN_INTERVAL:
             new_item = Item(items, all)
             new_item.spawn()
-            item_timer = current_time
-        
+            self.item_timer = current_time
+
         for item in items:
+            center = item.rect.center  # 衝突するとrectが画面外に戻されるので先に覚えておく
             if item.collide_bombs(bombs):
                 alien.gauge.current_value += 1
+                alien.speed += 0.3
                 item.kill()
-                item_sound.play()
-                background.blit(bgdtile, (0, 0))
-                screen.blit(background, (0, 0))
+                self.particles.burst(center, 150, "spark", speed=4.0, life=20)
+                sound.play(assets.item_sound, SOUND_PRIORITY_ITEM)
+                self.picked("Alien", ALIEN_SCORE)
             elif item.collide_shots(shots):
                 player.gauge.current_value += 1
+                player.speed += 0.3
                 item.kill()
-                item_sound.play()
-                background.blit(bgdtile, (0, 0))
-                screen.blit(background, (0, 0))
-        
-        pg.display.update(all.draw(screen))        
-        clock.tick(40)
+                self.particles.burst(center, 150, "spark", speed=4.0, life=20)
+                sound.play(assets.item_sound, SOUND_PRIORITY_ITEM)
+                self.picked("Player", PLAYER_SCORE)
+        self.log_gauges()
+
+    def draw(self, screen):
+        if self.simulation is not None:
+            self.draw_snapshot(screen)
+            return
+        self.cull()
+        view = self.camera.view
+        self.pan(view.topleft)
+        dirty = self.starfield.draw(screen)
+        rects = screen.blits(self.sprite_sequence())
+        dirty += self.sprite_rects + rects + self.particles.draw(screen, view)
+        self.sprite_rects = rects
+        self.game.present(None if self.full_redraw else dirty)
+        self.game.latency.presented(self.tick)
+
+
+class WinScene(Scene):
+    """
+    勝利画面
+    イベントループを止めずにWIN_SCREEN_TIMEミリ秒表示し、その後タイトルへ戻る。
+    [Space]か[Enter]で即座に再戦する。
+    """
+
+    def __init__(self, game):
+        super().__init__(game)
+        self.winner = "Player"
+        self.started = 0
+
+    def enter(self):
+        self.started = get_ticks()
+        self.redraw()
+
+    def redraw(self):
+        self.game.screen.blit(Win.surfaces[self.winner], (0, 0))
+        self.game.present()
+
+    def handle_event(self, event):
+        if event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE:
+            self.game.quit()
+        elif event.type == pg.KEYDOWN and event.key in (pg.K_SPACE, pg.K_RETURN):
+            # 発射キーを押しっぱなしのまま再戦に入らないよう少し待つ
+            if get_ticks() - self.started > REMATCH_GUARD_TIME:
+                self.game.change(self.game.play)
+
+    def update(self):
+        if get_ticks() - self.started > WIN_SCREEN_TIME:
+            self.game.change(self.game.title)
+
+
+class Presenter:
+    """
+    ゲームを描く論理的な画面(SCREENRECT.sizeのsurface)を、実際のウィンドウに出すクラス
+    ゲームはいつもsurfaceに描いてpresent()を呼ぶだけで、ウィンドウの大きさや全画面かどうかは気にしない。
+    出し方(mode):
+        "window"  : 640x480のウィンドウ。surfaceはウィンドウの画面そのもので、写す手間は無い(今までと同じ)
+        "scaled"  : pg.SCALEDで開き、モニターに合わせた拡大はSDLに任せる(surfaceはウィンドウの画面そのもの)
+        "integer" : scale倍の大きさのウィンドウを開き、present()で更新した範囲だけをpg.transform.scaleで
+                    ウィンドウの画面へ直接(新しいSurfaceを作らずに)整数倍に拡大して写す
+    ウィンドウの画面が論理的な画面より大きいとき(全画面など)は、収まる最大の整数倍で中央に出す。
+    全画面の切り替えはpg.display.toggle_fullscreenで行い、surfaceは作り直さない。
+    切り替えられない環境ではset_modeで開き直し、ウィンドウの画面の大きさが変わったときだけsurfaceを分ける。
+    present()にかかった時間をstatsに記録する。
+    """
+
+    MODES = ("window", "scaled", "integer")
+
+    def __init__(self, display, mode="window", winstyle=0, depth=0):
+        self.display = display
+        self.mode = mode
+        self.winstyle = winstyle
+        self.depth = depth
+        self.window_size = display.get_size()  # ウィンドウのときの大きさ(開き直すときに使う)
+        self.fullscreen = False
+        self.surface = display
+        self.scale = 1
+        self.origin = (0, 0)  # ウィンドウの画面上でsurfaceを出す左上の位置
+        self.fit()
+        self.stats = {"frames": 0, "total_ms": 0.0, "max_ms": 0.0}
+
+    @classmethod
+    def open(cls, mode="window", scale=DISPLAY_SCALE, winstyle=0, depth=0):
+        """
+        modeのウィンドウを開いてPresenterを返す。pg.SCALEDが使えない環境ではwindowにする
+        """
+        if mode == "scaled":
+            try:
+                return cls(pg.display.set_mode(SCREENRECT.size, winstyle | pg.SCALED, depth), mode, winstyle | pg.SCALED, depth)
+            except pg.error:
+                warn(f"no scaled display: {pg.get_error()}")
+                mode = "window"
+        if mode == "integer" and scale > 1:
+            size = (SCREENRECT.width * scale, SCREENRECT.height * scale)
+            return cls(pg.display.set_mode(size, winstyle, depth), mode, winstyle, depth)
+        return cls(pg.display.set_mode(SCREENRECT.size, winstyle, depth), "window", winstyle, depth)
+
+    def fit(self):
+        """
+        ウィンドウの画面の大きさから、拡大率と出す位置を決める
+        ウィンドウの画面が論理的な画面と同じ大きさでなくなったら、surfaceをウィンドウの画面から分ける。
+        """
+        width, height = self.display.get_size()
+        if (width, height) == SCREENRECT.size:
+            self.surface = self.display
+            self.scale = 1
+        else:
+            if self.surface is self.display:
+                self.surface = pg.Surface(SCREENRECT.size, 0, self.display)
+            self.scale = max(1, min(width // SCREENRECT.width, height // SCREENRECT.height))
+        self.origin = ((width - SCREENRECT.width * self.scale) // 2, (height - SCREENRECT.height * self.scale) // 2)
+
+    def present(self, rects=None):
+        """
+        surfaceのrectsの範囲(Noneなら全体)をウィンドウに出す。rectsが空なら何もしない
+        """
+        if rects is not None and not rects:
+            return
+        start = time.perf_counter()
+        surface, display = self.surface, self.display
+        if surface is display:
+            if rects is None:
+                pg.display.flip()
+            else:
+                pg.display.update(rects)
+        else:
+            scale = self.scale
+            x, y = self.origin
+            targets = []
+            for rect in (SCREENRECT,) if rects is None else rects:
+                rect = SCREENRECT.clip(rect)
+                if not rect:
+                    continue
+                target = pg.Rect(x + rect.x * scale, y + rect.y * scale, rect.width * scale, rect.height * scale)
+                if scale == 1:
+                    display.blit(surface, target, rect)
+                else:
+                    pg.transform.scale(surface.subsurface(rect), target.size, display.subsurface(target))
+                targets.append(target)
+            if rects is None:
+                pg.display.flip()
+            else:
+                pg.display.update(targets)
+        elapsed = (time.perf_counter() - start) * 1000
+        stats = self.stats
+        stats["frames"] += 1
+        stats["total_ms"] += elapsed
+        stats["max_ms"] = max(stats["max_ms"], elapsed)
+
+    def toggle_fullscreen(self):
+        """
+        全画面とウィンドウを切り替える。呼んだ側で場面を描き直すこと
+        """
+        self.fullscreen = not self.fullscreen
+        try:
+            pg.display.toggle_fullscreen()
+        except pg.error:
+            # 切り替えに対応していない環境では開き直す
+            flags = self.winstyle | (pg.FULLSCREEN if self.fullscreen else 0)
+            pg.display.set_mode(self.window_size, flags, self.depth)
+        self.display = pg.display.get_surface()
+        self.fit()
+        if self.surface is not self.display:
+            self.display.fill((0, 0, 0))  # 拡大した画面の周りの余白
+
+    def report(self):
+        stats = self.stats
+        average = stats["total_ms"] / max(1, stats["frames"])
+        width, height = self.display.get_size()
+        return (
+            f"present: {self.mode} {width}x{height} (x{self.scale}), "
+            f"avg {average:.3f} ms max {stats['max_ms']:.3f} ms over {stats['frames']} frames"
+        )
+
+
+class Keystate:
+    """
+    1ティック分の入力
+    pg.key.get_pressed()の戻り値と同じく、keystate[キー]で押されていれば1、いなければ0を返す。
+    """
+
+    __slots__ = ("held", "presses")
+
+    def __init__(self, held, presses):
+        self.held = held  # このティックで押されているキー
+        self.presses = presses  # このティックで押されたキー -> 押した時刻(perf_counter)
+
+    def __getitem__(self, key):
+        return int(key in self.held)
+
+    def pressed_at(self, key):
+        """
+        keyがこのティックで押されたならその時刻、そうでなければNoneを返す
+        """
+        return self.presses.get(key)
+
+
+class InputBuffer:
+    """
+    KEYDOWN/KEYUPのイベントを押した時刻付きでため、ティックごとの入力(Keystate)にまとめるクラス
+    フレームに1回pg.key.get_pressed()を見るだけだと、フレームの間に押して離したキーは見えない。
+    take()はためたイベントを古い順に反映し、同じキーが同じティックで2回変わる手前で止めて残りを次のティックに回す。
+    こうすると一瞬だけ押したキーも1ティックは押された状態になり、押し直しも取りこぼさない。
+    feed()はメインスレッドから、take()はシミュレーションのスレッドからも呼べる(取り出すのは1か所だけにする)。
+    """
+
+    def __init__(self, capacity=INPUT_BUFFER_SIZE):
+        self.events = deque(maxlen=capacity)  # (時刻, キー, 押したならTrue)
+        self.held = frozenset()
+        self.deferred = 0  # 次のティックに回した変化の数(フレーム内の短い入力を残せた数)
+
+    def feed(self, event, stamp):
+        """
+        イベントを受け取った時刻stamp(perf_counter)と一緒にためる。キー以外のイベントは無視する
+        """
+        if event.type in (pg.KEYDOWN, pg.KEYUP):
+            self.events.append((stamp, event.key, event.type == pg.KEYDOWN))
+
+    def take(self):
+        """
+        次のティックの入力を返す
+        """
+        events = self.events
+        held = set(self.held)
+        presses = {}
+        changed = set()
+        while events:
+            stamp, key, down = events[0]
+            if key in changed:
+                self.deferred += 1
+                break
+            events.popleft()
+            if down and key not in held:
+                held.add(key)
+                presses[key] = stamp
+            elif not down and key in held:
+                held.discard(key)
+            else:
+                continue
+            changed.add(key)
+        self.held = frozenset(held)
+        return Keystate(self.held, presses)
+
+    def clear(self):
+        """
+        ためたイベントを捨て、どのキーも押されていない状態にする(対戦の始めに呼ぶ)
+        """
+        self.events.clear()
+        self.held = frozenset()
+
+    def resync(self, pressed):
+        """
+        一時停止から戻ったときに呼ぶ。止まっている間のKEYUPは届いていないので、ためたイベントを捨て、
+        pressed(pg.key.get_pressed())で今も押されているキーだけを押された状態に残す
+        """
+        self.events.clear()
+        self.held = frozenset(key for key in self.held if pressed[key])
+
+
+class InputLatency:
+    """
+    キーを押してから弾が出るまで(input-to-fire)と、その弾が画面の更新に出るまで(input-to-photon)の時間を集めるクラス
+    押した時刻はイベントを受け取った時刻で、FramePacerが待ち時間にもINPUT_POLL_INTERVALごとに受け取るので、
+    フレームを待っている間に押した分の遅れも(その間隔の誤差で)含む。
+    画面の更新はPresenter.present()を終えた時点までで、モニターに映るまでの遅れは含まない。
+    """
+
+    def __init__(self, samples=LATENCY_SAMPLES):
+        self.fire_ms = deque(maxlen=samples)
+        self.photon_ms = deque(maxlen=samples)
+        self.awaiting = deque()  # (ティック, 押した時刻) 画面に出るのを待っている弾
+
+    def fired(self, pressed, tick):
+        self.fire_ms.append((time.perf_counter() - pressed) * 1000)
+        self.awaiting.append((tick, pressed))
+
+    def presented(self, tick):
+        """
+        tickまでの状態を画面に出したときに呼ぶ
+        """
+        awaiting = self.awaiting
+        now = time.perf_counter()
+        while awaiting and awaiting[0][0] <= tick:
+            self.photon_ms.append((now - awaiting.popleft()[1]) * 1000)
+
+    def clear(self):
+        self.awaiting.clear()
+
+    def report(self, deferred=0):
+        lines = [f"input latency ({deferred} sub-frame key changes kept for the next tick):"]
+        for label, samples in (("input-to-fire", self.fire_ms), ("input-to-photon", self.photon_ms)):
+            if not samples:
+                lines.append(f"  {label}: no samples")
+                continue
+            ordered = sorted(samples)
+            lines.append(
+                f"  {label}: median {statistics.median(ordered):.1f} ms, "
+                f"p95 {ordered[int(len(ordered) * 0.95)]:.1f} ms, max {ordered[-1]:.1f} ms ({len(ordered)} shots)"
+            )
+        return "\n".join(lines)
+
+
+class FramePacer:
+    """
+    フレームごとの処理時間を測り、次のフレームまでの待ち方と描画の品質を決めるクラス
+    ・次のフレームの時刻のFRAME_WAKE_MARGIN前までは眠ってCPUを譲り、残りだけをclockで合わせる。
+      処理時間(イベント処理から描画までで、待った時間は含まない)がフレームの予算(1000 / FRAME_RATE ms)の
+      FRAME_BUSY_HEADROOM未満なら余裕があるので、残りはclock.tick_busy_loopで正確に待つ。
+      それ以上ならclock.tickで待つ
+    ・予算を超えるフレームがQUALITY_DOWN_FRAMES続いたら品質(QUALITY_LEVELS)を1段下げ、
+      予算のQUALITY_UP_RATIO未満のフレームがQUALITY_UP_FRAMES続いたら1段上げる。
+      下げるのは早く、上げるのは遅くして、品質が行ったり来たりしないようにする
+    品質を変えるたびに理由をchangesに残し、出来事のログにも書く。
+    pollを渡すと、眠る間もINPUT_POLL_INTERVALごとに呼ぶ(キーを押した時刻を、待ち時間の分も含めて正確にするため)。
+    """
+
+    def __init__(self, clock, rate=FRAME_RATE, poll=None):
+        self.clock = clock
+        self.poll = poll
+        self.ticked = time.perf_counter()  # 前のフレームの待ちを終えた時刻
+        self.rate = rate
+        self.budget_ms = 1000 / rate
+        self.level = 0  # QUALITY_LEVELSの番号(大きいほど品質が低い)
+        self.started = 0.0  # 今のフレームの処理を始めた時刻(perf_counter)
+        self.streak = 0  # 予算を超えた(正)・十分余裕のあった(負)フレームが続いた数
+        self.streak_ms = 0.0  # 続いたフレームの処理時間の合計
+        self.frames = 0
+        self.busy_frames = 0  # ビジーループで待ったフレームの数
+        self.total_ms = 0.0
+        self.worst_ms = 0.0
+        self.level_frames = [0] * len(QUALITY_LEVELS)
+        self.changes = deque(maxlen=100)  # (フレーム番号, 品質の名前, 理由)
+
+    @property
+    def quality(self):
+        return QUALITY_LEVELS[self.level][0]
+
+    def begin(self):
+        self.started = time.perf_counter()
+
+    def end(self):
+        """
+        フレームの処理時間を記録して品質を見直し、次のフレームまで待つ
+        戻り値: bool : 品質を変えたらTrue
+        """
+        work_ms = (time.perf_counter() - self.started) * 1000
+        self.frames += 1
+        self.total_ms += work_ms
+        self.worst_ms = max(self.worst_ms, work_ms)
+        self.level_frames[self.level] += 1
+        changed = self.judge(work_ms)
+        deadline = self.ticked + self.budget_ms / 1000 - FRAME_WAKE_MARGIN
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            if self.poll is None:
+                time.sleep(remaining)
+                break
+            self.poll()
+            time.sleep(min(remaining, INPUT_POLL_INTERVAL))
+        if work_ms < self.budget_ms * FRAME_BUSY_HEADROOM:
+            self.busy_frames += 1
+            self.clock.tick_busy_loop(self.rate)
+        else:
+            self.clock.tick(self.rate)
+        self.ticked = time.perf_counter()
+        return changed
+
+    def judge(self, work_ms):
+        """
+        続けて予算を超えたか、続けて余裕があったかを数え、品質を1段上げ下げする
+        """
+        if work_ms > self.budget_ms:
+            if self.streak < 0:
+                self.streak, self.streak_ms = 0, 0.0
+            self.streak += 1
+        elif work_ms < self.budget_ms * QUALITY_UP_RATIO:
+            if self.streak > 0:
+                self.streak, self.streak_ms = 0, 0.0
+            self.streak -= 1
+        else:
+            self.streak, self.streak_ms = 0, 0.0
+            return False
+        self.streak_ms += work_ms
+        frames = abs(self.streak)
+        if self.streak >= QUALITY_DOWN_FRAMES and self.level < len(QUALITY_LEVELS) - 1:
+            self.level += 1
+        elif -self.streak >= QUALITY_UP_FRAMES and self.level > 0:
+            self.level -= 1
+        else:
+            return False
+        if self.streak > 0:
+            reason = f"avg {self.streak_ms / frames:.1f} ms over the {self.budget_ms:.1f} ms budget for {frames} frames"
+        else:
+            reason = (f"avg {self.streak_ms / frames:.1f} ms under {QUALITY_UP_RATIO:.0%} of the "
+                      f"{self.budget_ms:.1f} ms budget for {frames} frames")
+        self.changes.append((self.frames, self.quality, reason))
+        EVENTS.log("quality", level=self.quality, reason=reason)
+        self.streak, self.streak_ms = 0, 0.0
+        return True
+
+    def report(self):
+        if not self.frames:
+            return "frame pacing: no frames"
+        levels = ", ".join(
+            f"{name} {count / self.frames * 100:.0f}%" for (name, *_), count in zip(QUALITY_LEVELS, self.level_frames)
+        )
+        lines = [
+            f"frame pacing: {self.frames} frames, work avg {self.total_ms / self.frames:.1f} ms / worst "
+            f"{self.worst_ms:.1f} ms (budget {self.budget_ms:.1f} ms), busy-loop pacing "
+            f"{self.busy_frames / self.frames * 100:.0f}%, quality now {self.quality}",
+            f"  time at quality: {levels}",
+        ]
+        for frame, name, reason in list(self.changes)[-5:]:
+            lines.append(f"  frame {frame}: -> {name} ({reason})")
+        return "\n".join(lines)
+
+
+class Game:
+    """
+    画面・読み込み済みの素材・各場面を保持し、メインループを回すクラス
+    """
+
+    def __init__(self, screen, assets, winstyle=0, bestdepth=0, threaded=False, memory=False, history=None,
+                 presenter=None):
+        self.presenter = presenter or Presenter(screen, winstyle=winstyle, depth=bestdepth)
+        self.threaded = threaded  # Trueなら対戦中のシミュレーションを別スレッドで動かす
+        self.simulation_reports: List[str] = []
+        self.memory = MemoryMonitor() if memory else None  # Trueならメモリの使い方を見張る
+        self.history = history  # 対戦の記録を残すMatchHistory。残さないならNone
+        self.assets = assets
+        self.winstyle = winstyle
+        self.bestdepth = bestdepth
+        self.clock = pg.time.Clock()
+        self.input = InputBuffer()
+        self.latency = InputLatency()
+        self.polled: List[tuple] = []  # フレームの待ち時間に受け取った(時刻, キーのイベント)
+        self.pacer = FramePacer(self.clock, poll=self.poll_input)
+        self.sound = SoundManager()
+        self.title = TitleScene(self)
+        self.select = SelectScene(self)
+        self.play = PlayScene(self)
+        self.win = WinScene(self)
+        self.scene = None
+        self.paused = None  # 一時停止の理由("key"か"focus")。動いているときはNone
+        self.pause_started = 0
+
+    @property
+    def screen(self):
+        """
+        ゲームを描く画面(Presenterのsurface)
+        """
+        return self.presenter.surface
+
+    def present(self, rects=None):
+        self.presenter.present(rects)
+
+    def poll_input(self):
+        """
+        フレームの待ち時間にキーのイベントだけを受け取り、受け取った時刻を付けて次のフレームまでとっておく
+        """
+        now = time.perf_counter()
+        self.polled.extend((now, event) for event in pg.event.get((pg.KEYDOWN, pg.KEYUP)))
+
+    def events(self):
+        """
+        待ち時間に受け取ったものを先にして、このフレームで処理する(時刻, イベント)を返す
+        """
+        now = time.perf_counter()
+        events = self.polled + [(now, event) for event in pg.event.get()]
+        self.polled = []
+        return events
+
+    def apply_quality(self):
+        """
+        FramePacerの品質に合わせて、省いてもよい処理(パーティクル・背景・HUD・効果音)の量を変える
+        """
+        _, particles, stars, scrolling, hud_interval, voices = QUALITY_LEVELS[self.pacer.level]
+        play = self.play
+        play.particles.set_ceiling(int(play.particles.capacity * particles))
+        play.starfield.depth = stars
+        play.starfield.scrolling = scrolling
+        play.hud_interval = hud_interval
+        self.sound.voices = voices
+
+    def change(self, scene):
+        """
+        場面を切り替える
+        """
+        if self.scene is not None:
+            self.scene.exit()
+        self.scene = scene
+        scene.enter()
+
+    def quit(self):
+        self.scene.exit()
+        self.scene = None
+
+    def pause(self, reason):
+        """
+        シミュレーションと音を止める。[P]による一時停止("key")は[P]でだけ戻る
+        """
+        if self.paused == "key":
+            return
+        if self.paused is None:
+            self.pause_started = pg.time.get_ticks()
+            self.sound.pause()
+            if self.scene is not None:
+                self.scene.pause()
+            self.draw_pause()
+        self.paused = reason
+
+    def resume(self):
+        """
+        止めていた時間をPAUSED_TIMEに足して、タイマーが進まなかったことにして再開する
+        """
+        global PAUSED_TIME
+        PAUSED_TIME += pg.time.get_ticks() - self.pause_started
+        self.paused = None
+        self.input.resync(pg.key.get_pressed())  # 止まっている間に離したキーが押されたままにならないように
+        self.sound.resume()
+        if self.scene is not None:
+            self.scene.resume()
+            self.scene.redraw()
+
+    def draw_pause(self):
+        shade = pg.Surface(SCREENRECT.size, pg.SRCALPHA)
+        shade.fill((0, 0, 0, 160))
+        self.screen.blit(shade, (0, 0))
+        if pg.font:
+            font = get_font(64)
+            text = font.render("PAUSED", True, "white")
+            self.screen.blit(text, text.get_rect(center=(SCREENRECT.centerx, SCREENRECT.centery - 20)))
+            font = get_font(28)
+            text = font.render("Press P to resume", True, "white")
+            self.screen.blit(text, text.get_rect(center=(SCREENRECT.centerx, SCREENRECT.centery + 30)))
+        self.present()
+
+    def handle_paused_event(self, event):
+        """
+        一時停止中のイベントを処理する。終了するならFalseを返す
+        """
+        if event.type == pg.QUIT or (event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE):
+            return False
+        if event.type == pg.KEYDOWN and event.key == pg.K_p:
+            self.resume()
+        elif self.paused == "focus" and event.type in (pg.WINDOWFOCUSGAINED, pg.WINDOWRESTORED):
+            self.resume()
+        elif event.type in (pg.WINDOWEXPOSED, pg.VIDEOEXPOSE):
+            self.draw_pause()
+        return True
+
+    def toggle_fullscreen(self):
+        presenter = self.presenter
+        EVENTS.log("display", mode="windowed" if presenter.fullscreen else "fullscreen")
+        presenter.toggle_fullscreen()
+        if self.scene is not None:
+            self.scene.redraw()
+
+    def run(self, scene=None):
+        self.change(scene or self.title)
+        try:
+            self.loop()
+        finally:
+            if self.scene is not None:
+                self.scene.exit()
+
+    def loop(self):
+        pacer = self.pacer
+        while self.scene is not None:
+            if self.paused:
+                # 一時停止中はイベントが来るまで眠り、CPUを使わない
+                if not self.handle_paused_event(pg.event.wait()):
+                    return
+                continue
+            pacer.begin()
+            for stamp, event in self.events():
+                self.input.feed(event, stamp)
+                if event.type == pg.QUIT:
+                    return
+                if event.type == pg.KEYDOWN and event.key == pg.K_h:
+                    self.toggle_fullscreen()
+                elif event.type == pg.KEYDOWN and event.key == pg.K_p:
+                    self.pause("key")
+                elif event.type in (pg.WINDOWFOCUSLOST, pg.WINDOWMINIMIZED):
+                    self.pause("focus")
+                else:
+                    self.scene.handle_event(event)
+                if self.scene is None:
+                    return
+            if self.paused:
+                continue
+
+            scene = self.scene
+            self.sound.tick()
+            scene.update()
+            if self.scene is scene:  # update()中に場面が切り替わったら描画しない
+                scene.draw(self.screen)
+            if self.memory is not None:
+                self.memory.sample(self.play)
+            if pacer.end():
+                self.apply_quality()
+
+
+def main(winstyle=0, threaded=False, memory=False, log=False, display="window", scale=DISPLAY_SCALE, startup=False,
+         stats=False):
+    STARTUP.mark("module")
+    if log:  # 読み込み中の警告も書けるように、最初に開く
+        EVENTS.open()
+    try:
+        run_game(winstyle, threaded, memory, display, scale, startup, stats)
+    finally:
+        if log:
+            EVENTS.close()
+            print(EVENTS.report())
+
+
+def run_game(winstyle, threaded, memory, display, scale, startup, stats):
+    """
+    画面を開いて素材を読み、ゲームを終わるまで動かす。statsなら終了時に各計測のまとめを表示する
+    """
+    # 最初の画面を出すのに必要な画面だけを先に初期化し、残り(音など)はその後にする
+    if pg.get_sdl_version()[0] == 2:
+        pg.mixer.pre_init(MIXER_FREQUENCY, 32, 2, MIXER_BUFFER)
+    pg.display.init()
+
+    winstyle = 0  # |FULLSCREEN
+    bestdepth = pg.display.mode_ok(SCREENRECT.size, winstyle, 32)
+    presenter = Presenter.open(display, scale, winstyle, bestdepth)
+    screen = presenter.surface
+    pg.display.set_caption("こうかとんスターシュート")
+    pg.mouse.set_visible(0)
+    STARTUP.mark("display")
+
+    splash = Splash(presenter)
+    splash.draw(0)
+
+    # Initialize pygame
+    pg.init()
+    if pg.mixer and not pg.mixer.get_init():
+        warn("no sound")
+        pg.mixer = None
+    STARTUP.mark("pg.init")
+
+    assets = Assets(background=True)
+    if not splash.run(assets):
+        return
+
+    icon = load_image("3.png")
+    icon.set_colorkey(0, 0)
+    icon = pg.transform.scale(icon, (22, 32))
+    pg.display.set_icon(icon)
+
+    history = None
+    if sqlite3 is not None and not startup:  # 起動時間だけを測るときは記録のファイルを作らない
+        try:
+            history = MatchHistory(HISTORY_FILE)
+        except sqlite3.Error as e:  # 書き込めない場所に置かれているなど。記録は残さずに遊べるようにする
+            warn(f"match history disabled, {e}")
+    game = Game(screen, assets, winstyle, bestdepth, threaded, memory, history, presenter)
+    STARTUP.mark("game")
+    if startup:  # 起動時間だけを測る(bench.py startup)
+        game.change(game.title)
+        game.quit()
+        print(STARTUP.report())
+        return
+    game.run()
+    if history is not None:
+        if stats:
+            print(history.report())
+        history.close()
+    if stats:
+        if game.sound.enabled:
+            print(game.sound.report())
+        print(game.pacer.report())
+        print(presenter.report())
+        print(game.latency.report(game.input.deferred))
+        print(STARTUP.report())
+        for report in game.simulation_reports:
+            print(report)
+    if game.memory is not None:
+        print(game.memory.report())
+
     if pg.mixer:
         pg.mixer.music.fadeout(1000)
     pg.time.wait(1000)
 
 
 if __name__ == "__main__":
-    main()
+    display, scale = "window", DISPLAY_SCALE
+    if "--scaled" in sys.argv:
+        display = "scaled"
+    elif "--scale" in sys.argv:
+        display = "integer"
+        args = sys.argv[sys.argv.index("--scale") + 1:]
+        if args and args[0].isdigit():
+            scale = int(args[0])
+    main(threaded="--threaded" in sys.argv, memory="--memory" in sys.argv, log="--log" in sys.argv,
+         display=display, scale=scale, startup="--startup" in sys.argv, stats="--stats" in sys.argv)
     pg.quit()